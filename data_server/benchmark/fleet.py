@@ -0,0 +1,284 @@
+import argparse
+import http.client
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+
+# Simulates a fleet of ESP32 devices posting periodic and historical data (the same JSON as sendPeriodicData and
+# sendHistoricalData in esp32/uwb_tapo/uwb_tapo.ino) while dashboard clients hit the read routes, and reports throughput,
+# latency percentiles and error rates per route. By default it starts the data server against the SQLite stand-in
+# database (DB_BACKEND=sqlite) in a temporary directory, so runs are reproducible without MariaDB
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server")
+SIMULATION_START = datetime(2024, 1, 1)     # Device clocks start here, so every run writes the same keys
+INGEST_METRICS = ("shuteye_ingest_flush_failures_total", "shuteye_ingest_failed_rows_total", "shuteye_ingest_discarded_rows_total",
+                  "shuteye_ingest_dropped_rows_total", "shuteye_ingest_rejected_samples_total", "shuteye_ingest_pending_rows")
+
+class Recorder:     # Collects the latency and outcome of every request, per route
+  def __init__(self):
+    self._latencies = {}
+    self._errors = {}
+    self._lock = threading.Lock()
+
+  def record(self, route: str, latency_ms: float, ok: bool) -> None:
+    with self._lock:
+      self._latencies.setdefault(route, []).append(latency_ms)
+      self._errors[route] = self._errors.get(route, 0) + (0 if ok else 1)
+
+  def summary(self, duration: float) -> dict:
+    with self._lock:
+      results = {}
+      for route, latencies in sorted(self._latencies.items()):
+        latencies = sorted(latencies)
+        results[route] = {
+          "requests": len(latencies),
+          "errors": self._errors[route],
+          "error_rate": self._errors[route] / len(latencies),
+          "throughput_rps": len(latencies) / duration,
+          "p50_ms": percentile(latencies, 50),
+          "p95_ms": percentile(latencies, 95),
+          "p99_ms": percentile(latencies, 99),
+        }
+      return results
+
+def percentile(sorted_values: list, percent: float) -> float:    # Nearest-rank percentile
+  return sorted_values[max(0, math.ceil(percent / 100 * len(sorted_values)) - 1)]
+
+class Client:     # Opens a new connection per request, as the ESP32 HTTPClient does
+  def __init__(self, url: str, recorder: Recorder, timeout: float):
+    parts = urlsplit(url)
+    self.host, self.port = parts.hostname, parts.port or 80
+    self.recorder = recorder
+    self.timeout = timeout
+
+  def request(self, route: str, method: str, path: str, payload=None) -> None:
+    body = json.dumps(payload) if payload is not None else None
+    started = time.perf_counter()
+    ok = False
+    try:
+      connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+      try:
+        connection.request(method, path, body=body, headers={"Content-Type": "application/json"} if body else {})
+        response = connection.getresponse()
+        response.read()
+        ok = response.status < 400
+      finally:
+        connection.close()
+    except (OSError, http.client.HTTPException):
+      pass
+    self.recorder.record(route, (time.perf_counter() - started) * 1000, ok)
+
+class Device(threading.Thread):     # One simulated ESP32, sending a periodic sample (or a bulk batch of them) and historical data on their intervals
+  def __init__(self, index: int, client: Client, stopped: threading.Event, args, rng: random.Random):
+    super().__init__(name=f"device-{index}", daemon=True)
+    self.appliance_name = appliance_name(index)
+    self.client = client
+    self.stopped = stopped
+    self.args = args
+    self.rng = random.Random(rng.random())
+    self.sample_index = 0
+    self.pending = []
+
+  def periodic_sample(self) -> dict:
+    local_time = SIMULATION_START + timedelta(seconds=self.sample_index * self.args.periodic_interval)
+    self.sample_index += 1
+    return {
+      "appliance_name": self.appliance_name,
+      "local_time": local_time.strftime("%Y-%m-%d %H:%M:%S"),
+      "current_power": self.rng.randint(0, 60000),
+      "distance_ultrasonic": 0,
+      "distance_bluetooth": self.rng.randint(0, 500),
+      "distance_ultrawideband": self.rng.randint(0, 500),
+      "user_presence_detected": self.rng.random() < 0.5,
+    }
+
+  def historical_data(self) -> dict:
+    local_time = SIMULATION_START + timedelta(seconds=self.sample_index * self.args.periodic_interval)
+    return {
+      "appliance_name": self.appliance_name,
+      "local_time": local_time.strftime("%Y-%m-%d %H:%M:%S"),
+      "today_runtime": self.rng.randint(0, 1440),
+      "month_runtime": self.rng.randint(0, 44640),
+      "today_energy": self.rng.randint(0, 5000),
+      "month_energy": self.rng.randint(0, 150000),
+    }
+
+  def run(self) -> None:
+    next_periodic = time.monotonic() + self.rng.uniform(0, self.args.periodic_interval)    # Spread devices out instead of posting in lockstep
+    next_historical = next_periodic + self.rng.uniform(0, self.args.historical_interval)
+    while not self.stopped.wait(max(0, min(next_periodic, next_historical) - time.monotonic())):
+      now = time.monotonic()
+      if now >= next_periodic:
+        next_periodic += self.args.periodic_interval
+        if self.args.bulk > 1:
+          self.pending.append(self.periodic_sample())
+          if len(self.pending) >= self.args.bulk:
+            self.client.request("POST /shuteye_periodic_measurement_data/bulk", "POST", "/shuteye_periodic_measurement_data/bulk", self.pending)
+            self.pending = []
+        else:
+          self.client.request("POST /shuteye_periodic_measurement_data", "POST", "/shuteye_periodic_measurement_data", self.periodic_sample())
+      if now >= next_historical:
+        next_historical += self.args.historical_interval
+        self.client.request("POST /shuteye_historical_data", "POST", "/shuteye_historical_data", self.historical_data())
+    if self.pending:     # Sends the partly filled bulk batch so every sample generated is posted
+      self.client.request("POST /shuteye_periodic_measurement_data/bulk", "POST", "/shuteye_periodic_measurement_data/bulk", self.pending)
+      self.pending = []
+
+class Dashboard(threading.Thread):     # One web or mobile app user, loading the dropdowns and charts for random appliances
+  def __init__(self, index: int, client: Client, stopped: threading.Event, args, rng: random.Random):
+    super().__init__(name=f"dashboard-{index}", daemon=True)
+    self.client = client
+    self.stopped = stopped
+    self.args = args
+    self.rng = random.Random(rng.random())
+
+  def run(self) -> None:
+    date = SIMULATION_START.strftime("%Y-%m-%d")
+    while not self.stopped.wait(self.rng.uniform(0, 2 * self.args.dashboard_interval)):
+      name = appliance_name(self.rng.randrange(self.args.devices))
+      route, path = self.rng.choice([
+        ("GET /appliance_names", "/appliance_names"),
+        ("GET /available_dates/{appliance_name}", f"/available_dates/{name}"),
+        ("GET /shuteye_energy_summary/{appliance_name}", f"/shuteye_energy_summary/{name}?date={date}&bucket_minutes=60"),
+        ("GET /shuteye_historical_data/{appliance_name}", f"/shuteye_historical_data/{name}"),
+        ("GET /shuteye_periodic_measurement_data/{appliance_name}", f"/shuteye_periodic_measurement_data/{name}?limit=500&format=columnar"),
+      ])
+      self.client.request(route, "GET", path)
+
+def appliance_name(index: int) -> str:
+  return f"bench-device-{index:03d}"
+
+def start_server(port: int, workdir: str) -> subprocess.Popen:    # Runs the data server against a fresh SQLite stand-in database
+  env = dict(os.environ, DB_BACKEND="sqlite", DB_SQLITE_PATH=os.path.join(workdir, "ShutEyeDataServer.sqlite3"),
+             ARCHIVE_DIR=os.path.join(workdir, "archive"), RETENTION_INTERVAL="0", MQTT_HOST="")
+  return subprocess.Popen([sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+                          cwd=SERVER_DIR, env=env)
+
+def wait_until_ready(url: str, timeout: float = 30) -> None:
+  parts = urlsplit(url)
+  deadline = time.monotonic() + timeout
+  while time.monotonic() < deadline:
+    try:
+      connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=1)
+      connection.request("GET", "/appliance_names")
+      connection.getresponse().read()
+      connection.close()
+      return
+    except (OSError, http.client.HTTPException):
+      time.sleep(0.2)
+  raise RuntimeError(f"Data server at {url} did not start within {timeout} seconds")
+
+def scrape_ingest_metrics(url: str):    # Totals of the server's ingest counters from /metrics, or None if the server does not serve them
+  parts = urlsplit(url)
+  try:
+    connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=5)
+    try:
+      connection.request("GET", "/metrics")
+      response = connection.getresponse()
+      text = response.read().decode()
+    finally:
+      connection.close()
+  except (OSError, http.client.HTTPException):
+    return None
+  if response.status != 200:
+    return None
+  totals = dict.fromkeys(INGEST_METRICS, 0.0)
+  for line in text.splitlines():
+    name = line.split("{", 1)[0].split(" ", 1)[0]
+    if name in totals:
+      totals[name] += float(line.rsplit(" ", 1)[1])
+  return totals
+
+def drain_ingest(url: str, before: dict, timeout: float):    # Waits for the write-behind buffers to empty, then returns the ingest counters accumulated during the run
+  # The ingest routes answer before rows are written, so failed inserts only show up in the server's metrics
+  deadline = time.monotonic() + timeout
+  after = scrape_ingest_metrics(url)
+  while after is not None and after["shuteye_ingest_pending_rows"] > 0 and time.monotonic() < deadline:
+    time.sleep(0.5)
+    after = scrape_ingest_metrics(url)
+  if before is None or after is None:
+    return None
+  return {name.replace("shuteye_ingest_", ""): after[name] - (0 if name == "shuteye_ingest_pending_rows" else before[name]) for name in INGEST_METRICS}
+
+def run(args) -> dict:
+  rng = random.Random(args.seed)
+  recorder = Recorder()
+  client = Client(args.url, recorder, args.timeout)
+  stopped = threading.Event()
+  ingest_before = scrape_ingest_metrics(args.url)
+  workers = ([Device(index, client, stopped, args, rng) for index in range(args.devices)]
+             + [Dashboard(index, client, stopped, args, rng) for index in range(args.dashboards)])
+  started = time.monotonic()
+  for worker in workers:
+    worker.start()
+  time.sleep(args.duration)
+  stopped.set()
+  for worker in workers:
+    worker.join()
+  duration = time.monotonic() - started
+  return {
+    "timestamp": datetime.now().isoformat(timespec="seconds"),
+    "config": {key: value for key, value in vars(args).items() if key != "output"},
+    "duration_s": duration,
+    "routes": recorder.summary(duration),
+    "ingest": drain_ingest(args.url, ingest_before, args.drain_timeout),
+  }
+
+def print_report(results: dict) -> None:
+  print(f"{'route':<55} {'requests':>8} {'req/s':>8} {'errors':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+  for route, stats in results["routes"].items():
+    print(f"{route:<55} {stats['requests']:>8} {stats['throughput_rps']:>8.2f} {stats['error_rate']:>7.2%} "
+          f"{stats['p50_ms']:>8.1f} {stats['p95_ms']:>8.1f} {stats['p99_ms']:>8.1f}")
+  ingest = results["ingest"]
+  if ingest is None:
+    print("Ingest: /metrics not available, failed inserts are not reported")
+  else:
+    print(f"Ingest: {ingest['flush_failures_total']:.0f} failed flushes ({ingest['failed_rows_total']:.0f} rows retried), "
+          f"{ingest['discarded_rows_total']:.0f} rows discarded, {ingest['dropped_rows_total']:.0f} rows dropped, "
+          f"{ingest['rejected_samples_total']:.0f} samples refused, {ingest['pending_rows']:.0f} rows still pending")
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description="Load test the ShutEye data server with a simulated fleet of devices and dashboards")
+  parser.add_argument("--url", help="Benchmark an already running data server instead of starting one on the SQLite stand-in")
+  parser.add_argument("--port", type=int, default=6544, help="Port for the data server started by the benchmark")
+  parser.add_argument("--devices", type=int, default=20, help="Simulated ESP32 devices")
+  parser.add_argument("--dashboards", type=int, default=2, help="Simulated dashboard users")
+  parser.add_argument("--duration", type=float, default=60, help="Seconds to run the load for")
+  parser.add_argument("--periodic-interval", type=float, default=5, help="Seconds between periodic samples per device (PERIODIC_UPDATE_INTERVAL)")
+  parser.add_argument("--historical-interval", type=float, default=60, help="Seconds between historical posts per device (HISTORICAL_UPDATE_INTERVAL)")
+  parser.add_argument("--bulk", type=int, default=1, help="Periodic samples per request, more than 1 uses the bulk route")
+  parser.add_argument("--dashboard-interval", type=float, default=1, help="Mean seconds between requests per dashboard user")
+  parser.add_argument("--timeout", type=float, default=10, help="Request timeout in seconds")
+  parser.add_argument("--drain-timeout", type=float, default=15, help="Seconds to wait after the run for the server to write out buffered rows")
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--output", help="Also write the results as JSON to this file, to track regressions between runs")
+  args = parser.parse_args()
+
+  server = None
+  with tempfile.TemporaryDirectory() as workdir:
+    if args.url is None:
+      args.url = f"http://127.0.0.1:{args.port}"
+      server = start_server(args.port, workdir)
+    try:
+      wait_until_ready(args.url)
+      results = run(args)
+    finally:
+      if server is not None:
+        server.terminate()
+        server.wait()
+
+  print_report(results)
+  if args.output:
+    with open(args.output, "w") as output:
+      json.dump(results, output, indent=2)
+
+if __name__ == "__main__":
+  main()
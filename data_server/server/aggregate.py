@@ -0,0 +1,88 @@
+from datetime import datetime, timedelta
+import numpy as np
+
+MILLIWATT_SECONDS_PER_WATT_HOUR = 3600 * 1000
+
+def energy_summary(times: list, power: list, presence: list, start: datetime, end: datetime, bucket_seconds: int, rollups: dict = None) -> dict:
+  # Time-weighted energy and presence per bucket: each pair of consecutive samples in the same clock hour contributes
+  # (time difference) * (power of the earlier sample) to the bucket of the earlier sample, attributed to presence or no presence
+  # by the earlier sample, and pairs that straddle an hour boundary are not counted. For hourly buckets this is what the web app
+  # used to compute in the browser, and it is the rule rollup() compacts by, so a summary is the same before and after the raw
+  # samples are compacted. rollups (columns of minute or hour rollup rows) cover older parts of the range whose raw samples were
+  # compacted, with buckets starting on a whole minute (or whole hour for hour rollups)
+  bucket_count = max(0, -(-int((end - start).total_seconds()) // bucket_seconds))
+  bucket_starts = [(start + timedelta(seconds=bucket_seconds * index)).strftime("%Y-%m-%d %H:%M:%S") for index in range(bucket_count)]
+
+  epoch_seconds = np.asarray(times, dtype="datetime64[s]").astype(np.int64)   # Samples must be sorted by time
+  seconds = epoch_seconds - np.datetime64(start, "s").astype(np.int64)
+  power = np.asarray(power, dtype=np.float64)
+  presence = np.asarray(presence, dtype=bool)
+
+  in_range = (seconds >= 0) & (seconds < bucket_count * bucket_seconds)
+  epoch_seconds, seconds, power, presence = epoch_seconds[in_range], seconds[in_range], power[in_range], presence[in_range]
+  buckets = seconds // bucket_seconds
+
+  hours = epoch_seconds // 3600
+  same_hour = hours[1:] == hours[:-1]
+  pair_buckets = buckets[:-1][same_hour]
+  durations = np.diff(seconds)[same_hour].astype(np.float64)
+  milliwatt_seconds = durations * power[:-1][same_hour]
+  present = presence[:-1][same_hour]
+
+  total_energy = np.bincount(pair_buckets, weights=milliwatt_seconds, minlength=bucket_count).astype(np.float64)   # bincount of nothing comes back as integers
+  presence_energy = np.bincount(pair_buckets, weights=milliwatt_seconds * present, minlength=bucket_count).astype(np.float64)
+  total_time = np.bincount(pair_buckets, weights=durations, minlength=bucket_count).astype(np.float64)
+  presence_time = np.bincount(pair_buckets, weights=durations * present, minlength=bucket_count).astype(np.float64)
+
+  if rollups is not None and len(rollups["bucket_start"]):
+    rollup_seconds = (np.asarray(rollups["bucket_start"], dtype="datetime64[s]") - np.datetime64(start, "s")).astype(np.int64)
+    in_range = (rollup_seconds >= 0) & (rollup_seconds < bucket_count * bucket_seconds)
+    rollup_buckets = rollup_seconds[in_range] // bucket_seconds
+    for totals, column in ((total_energy, "energy"), (presence_energy, "presence_energy"), (total_time, "covered_seconds"), (presence_time, "presence_seconds")):
+      totals += np.bincount(rollup_buckets, weights=np.asarray(rollups[column], dtype=np.float64)[in_range], minlength=bucket_count)
+
+  no_presence_energy = total_energy - presence_energy
+  presence_percentage = np.divide(presence_time * 100, total_time, out=np.zeros(bucket_count), where=total_time > 0)
+
+  return {
+    "bucket_start": bucket_starts,
+    "total_energy_wh": (total_energy / MILLIWATT_SECONDS_PER_WATT_HOUR).tolist(),
+    "presence_energy_wh": (presence_energy / MILLIWATT_SECONDS_PER_WATT_HOUR).tolist(),
+    "no_presence_energy_wh": (no_presence_energy / MILLIWATT_SECONDS_PER_WATT_HOUR).tolist(),
+    "presence_percentage": presence_percentage.tolist(),
+  }
+
+def rollup(times: list, power: list, presence: list, distances: list, bucket_seconds: int) -> dict:
+  # Compacts sorted raw samples of one appliance into per-bucket rows. Each pair of consecutive samples in the same hour is
+  # credited to the bucket of the earlier sample, the same rule energy_summary() applies to raw samples, so summing minute
+  # rollups into any whole-minute buckets (or hour rollups into whole-hour buckets) gives exactly the raw result.
+  # distances holds (ultrasonic, bluetooth, ultrawideband) per sample
+  seconds = np.asarray(times, dtype="datetime64[s]").astype(np.int64)
+  power = np.asarray(power, dtype=np.int64)
+  presence = np.asarray(presence, dtype=bool)
+  distances = np.asarray(distances, dtype=np.int64).reshape(-1, 3)
+
+  durations = np.zeros(len(seconds), dtype=np.int64)
+  if len(seconds) > 1:
+    hours = seconds // 3600
+    durations[:-1] = np.where(hours[1:] == hours[:-1], np.diff(seconds), 0)
+
+  buckets = seconds // bucket_seconds
+  starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]]) if len(buckets) else np.zeros(0, dtype=np.int64)
+  counts = np.diff(np.r_[starts, len(buckets)])
+  energy = durations * power
+
+  def sums(values):
+    return np.add.reduceat(values, starts, axis=0) if len(starts) else np.zeros((0,) + values.shape[1:], dtype=values.dtype)
+
+  return {
+    "bucket_start": (buckets[starts] * bucket_seconds).astype("datetime64[s]"),
+    "sample_count": counts,
+    "energy": sums(energy),
+    "presence_energy": sums(energy * presence),
+    "covered_seconds": sums(durations),
+    "presence_seconds": sums(durations * presence),
+    "min_distance": np.minimum.reduceat(distances, starts, axis=0) if len(starts) else distances[:0],
+    "max_distance": np.maximum.reduceat(distances, starts, axis=0) if len(starts) else distances[:0],
+    "avg_distance": sums(distances) / counts[:, None] if len(starts) else distances[:0].astype(np.float64),
+  }
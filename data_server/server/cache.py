@@ -0,0 +1,46 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+cache_ttl = float(os.environ.get('READ_CACHE_TTL', 300))          # Seconds a cached lookup is served before it is reloaded from the database
+cache_size = int(os.environ.get('READ_CACHE_SIZE', 1024))         # Most entries kept, the least recently used are evicted first
+
+class TTLCache:     # Thread-safe LRU cache whose entries also expire after ttl seconds, the ingest paths invalidate entries as soon as new data is committed
+  def __init__(self, maxsize: int = cache_size, ttl: float = cache_ttl):
+    self.maxsize = maxsize
+    self.ttl = ttl
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+    self._generation = 0     # Bumped by every invalidation so a load that raced with one is not cached
+
+  def get_or_load(self, key: tuple, load):    # Returns the cached value for key, calling load() to fill it on a miss or after expiry
+    now = time.monotonic()
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is not None and entry[0] > now:
+        self._entries.move_to_end(key)
+        return entry[1]
+      generation = self._generation
+    value = load()     # Loaded outside the lock so a slow query does not block other lookups
+    with self._lock:
+      if generation != self._generation:
+        return value
+      self._entries[key] = (now + self.ttl, value)
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.maxsize:
+        self._entries.popitem(last=False)
+    return value
+
+  def invalidate(self, *keys: tuple) -> None:
+    with self._lock:
+      self._generation += 1
+      for key in keys:
+        self._entries.pop(key, None)
+
+  def clear(self) -> None:
+    with self._lock:
+      self._generation += 1
+      self._entries.clear()
+
+read_cache = TTLCache()
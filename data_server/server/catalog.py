@@ -0,0 +1,95 @@
+from db import get_cursor, create_missing_tables, require_tables
+from cache import read_cache
+from retention import create_rollup_tables
+
+# ShutEyeApplianceCatalog and ShutEyeApplianceActiveDates (created by init_db.py) summarize which appliances have periodic
+# data and on which dates, so the web and mobile app dropdowns never scan ShutEyeDeviceEnergyDataPeriodicMeasurement
+
+CATALOG_TABLES = ("ShutEyeApplianceCatalog", "ShutEyeApplianceActiveDates")
+require_tables(*CATALOG_TABLES)     # Databases initialized before the catalog existed get its tables, so inserts and lookups do not fail
+
+def create_catalog_tables() -> None:    # Adds the catalog tables to a database initialized before they existed, without touching its data
+  create_missing_tables(*CATALOG_TABLES)
+
+def update_catalog(cursor, rows: list) -> None:    # Folds a batch of periodic measurement rows into the catalog, on the same cursor (and transaction) that inserted them
+  seen = {}
+  dates = set()
+  for row in rows:
+    appliance_name, local_time = row[0], row[1]
+    first_seen, last_seen = seen.get(appliance_name, (local_time, local_time))
+    seen[appliance_name] = (min(first_seen, local_time), max(last_seen, local_time))
+    dates.add((appliance_name, local_time.date()))
+  if not seen:
+    return
+
+  cursor.execute("insert into ShutEyeApplianceCatalog(appliance_name, first_seen, last_seen) values "
+                 + ", ".join(["(%s, %s, %s)"] * len(seen))
+                 + " on duplicate key update first_seen = LEAST(first_seen, VALUES(first_seen)), last_seen = GREATEST(last_seen, VALUES(last_seen))",
+                 [value for appliance_name, (first_seen, last_seen) in seen.items() for value in (appliance_name, first_seen, last_seen)])
+  cursor.execute("insert into ShutEyeApplianceActiveDates(appliance_name, active_date) values "
+                 + ", ".join(["(%s, %s)"] * len(dates))
+                 + " on duplicate key update appliance_name = appliance_name",
+                 [value for date in sorted(dates) for value in date])
+
+def invalidate_periodic(appliance_names) -> None:    # Drops cached lookups that a committed batch of periodic measurements may have changed
+  read_cache.invalidate(("appliance_names",), *[("available_dates", appliance_name) for appliance_name in set(appliance_names)])
+
+def invalidate_historical(appliance_names) -> None:
+  read_cache.invalidate(*[("latest_historical", appliance_name) for appliance_name in set(appliance_names)])
+
+def fetch_appliance_names() -> list:
+  def load():
+    with get_cursor() as cursor:
+      cursor.execute("SELECT appliance_name FROM ShutEyeApplianceCatalog ORDER BY appliance_name;")
+      return [name[0] for name in cursor.fetchall()]
+  return read_cache.get_or_load(("appliance_names",), load)
+
+def fetch_available_dates(appliance_name: str) -> list:
+  def load():
+    with get_cursor() as cursor:
+      cursor.execute("SELECT active_date FROM ShutEyeApplianceActiveDates WHERE appliance_name = %s ORDER BY active_date DESC;", (appliance_name,))
+      return [date[0].strftime("%Y-%m-%d") for date in cursor.fetchall()]
+  return read_cache.get_or_load(("available_dates", appliance_name), load)
+
+def fetch_latest_historical(appliance_name: str) -> list:    # Latest ShutEyeDeviceEnergyDataHistorical row for the appliance (an empty list if there is none)
+  def load():
+    with get_cursor() as cursor:
+      cursor.execute("SELECT * FROM ShutEyeDeviceEnergyDataHistorical WHERE appliance_name = %s ORDER BY local_time DESC LIMIT 1;", (appliance_name,))
+      return cursor.fetchall()
+  return read_cache.get_or_load(("latest_historical", appliance_name), load)
+
+def fetch_compacted_until(appliance_name: str):    # Time before which the appliance's raw samples have been compacted by retention.py (None if never)
+  def load():
+    with get_cursor() as cursor:
+      cursor.execute("SELECT compacted_until FROM ShutEyeApplianceCatalog WHERE appliance_name = %s;", (appliance_name,))
+      records = cursor.fetchall()
+      return records[0][0] if records else None
+  return read_cache.get_or_load(("compacted_until", appliance_name), load)
+
+def rebuild_catalog() -> None:    # Recomputes the catalog from the periodic table and hour rollups, for databases that already held data before the catalog existed
+  create_catalog_tables()
+  create_rollup_tables()     # The rebuild also reads the hour rollups
+  with get_cursor(commit=True) as cursor:
+    cursor.execute("DELETE FROM ShutEyeApplianceActiveDates;")
+    cursor.execute("""
+      INSERT INTO ShutEyeApplianceCatalog(appliance_name, first_seen, last_seen)
+      SELECT appliance_name, MIN(first_seen), MAX(last_seen) FROM (
+        SELECT appliance_name, MIN(local_time) AS first_seen, MAX(local_time) AS last_seen
+        FROM ShutEyeDeviceEnergyDataPeriodicMeasurement GROUP BY appliance_name
+        UNION ALL
+        SELECT appliance_name, MIN(bucket_start), MAX(bucket_start)
+        FROM ShutEyeDeviceEnergyDataHourly GROUP BY appliance_name
+      ) AS seen
+      GROUP BY appliance_name
+      ON DUPLICATE KEY UPDATE first_seen = VALUES(first_seen), last_seen = VALUES(last_seen);
+    """)     # Existing rows are updated rather than deleted so their compacted_until watermark is kept
+    cursor.execute("""
+      INSERT INTO ShutEyeApplianceActiveDates(appliance_name, active_date)
+      SELECT DISTINCT appliance_name, DATE(local_time) FROM ShutEyeDeviceEnergyDataPeriodicMeasurement
+      UNION
+      SELECT DISTINCT appliance_name, DATE(bucket_start) FROM ShutEyeDeviceEnergyDataHourly;
+    """)
+  read_cache.clear()
+
+if __name__ == "__main__":      # Run directly to backfill the catalog from existing data
+  rebuild_catalog()
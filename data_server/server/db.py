@@ -0,0 +1,148 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+import mysql.connector as mysql
+from mysql.connector import pooling
+from dotenv import load_dotenv
+import metrics
+
+load_dotenv()                 # Retreives the credentials needed to conenct to the data server
+db_backend = os.environ.get('DB_BACKEND', 'mysql')             # "mysql" for the MariaDB data server, "sqlite" for the stand-in in sqlite_backend.py (e.g. for benchmarks)
+db_host = "localhost"
+db_user = "root"
+db_pass = os.environ['MYSQL_ROOT_PASSWORD'] if db_backend == 'mysql' else ''
+db_name = "ShutEyeDataServer"
+sqlite_path = os.environ.get('DB_SQLITE_PATH') or 'ShutEyeDataServer.sqlite3'
+
+schema_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "init_db.sql")
+
+pool_size = int(os.environ.get('DB_POOL_SIZE', 8))              # Number of connections kept open to the data server (mysql-connector allows at most 32)
+pool_timeout = float(os.environ.get('DB_POOL_TIMEOUT', 10))     # Seconds a request waits for a free connection before giving up
+
+_pool = None
+_pool_lock = threading.Lock()
+_pool_slots = threading.BoundedSemaphore(pool_size)   # mysql-connector raises instead of blocking when the pool is empty, so callers queue here instead
+_required_tables = []     # Tables from init_db.sql created when the pool is, see require_tables()
+
+class PoolTimeoutError(mysql.Error):     # Raised when no connection is released back to the pool within pool_timeout
+  pass
+
+ROW_ERRORS = (mysql.errors.DataError, mysql.errors.IntegrityError, TypeError, ValueError)    # Errors caused by the values written (bad data, constraint violations), which retrying cannot fix
+
+STATEMENTS = ("select", "insert", "update", "delete")     # Statement types timed separately, anything else is reported as "other"
+
+class TimedCursor:     # Wraps a cursor to time its statements and fetches for the /metrics route
+  def __init__(self, cursor):
+    self._cursor = cursor
+
+  def execute(self, query: str, params=()):
+    statement = query.lstrip()[:6].lower()
+    statement = statement if statement in STATEMENTS else "other"
+    started = time.perf_counter()
+    try:
+      return self._cursor.execute(query, params)
+    except Exception:
+      metrics.db_errors.inc("query")
+      raise
+    finally:
+      metrics.db_query_duration.observe(time.perf_counter() - started, statement)
+
+  def fetchall(self) -> list:
+    with metrics.db_fetch_duration.time():
+      return self._cursor.fetchall()
+
+  def fetchmany(self, size: int) -> list:
+    with metrics.db_fetch_duration.time():
+      return self._cursor.fetchmany(size)
+
+  def __getattr__(self, name: str):
+    return getattr(self._cursor, name)
+
+def require_tables(*tables: str) -> None:    # Registers tables a module needs, created if missing as soon as the database is first reached (so also when the server started before MariaDB)
+  _required_tables.extend(tables)
+
+def create_table_statements(tables) -> list:    # CREATE TABLE IF NOT EXISTS statements for the given tables, from their definitions in init_db.sql
+  with open(schema_path) as schema:
+    statements = [statement.strip() for statement in schema.read().split(";")]
+  return ["CREATE TABLE IF NOT EXISTS " + statement[len("CREATE TABLE "):] for statement in statements
+          if statement.upper().startswith("CREATE TABLE ") and statement.split()[2] in tables]
+
+def get_pool() -> pooling.MySQLConnectionPool:     # Creates the shared pool on first use so importing this module does not need the database to be up
+  global _pool
+  if _pool is None:
+    with _pool_lock:
+      if _pool is None:
+        if db_backend == 'sqlite':
+          from sqlite_backend import SQLitePool
+          pool = SQLitePool(sqlite_path, pool_size)
+        else:
+          pool = pooling.MySQLConnectionPool(pool_name="shuteye_pool", pool_size=pool_size, pool_reset_session=True, consume_results=True,
+                                             host=db_host, database=db_name, user=db_user, passwd=db_pass)
+        db = pool.get_connection()     # If this fails the pool is not kept, and the next caller tries again
+        try:
+          cursor = db.cursor()
+          for statement in create_table_statements(_required_tables):
+            cursor.execute(statement)
+          cursor.close()
+          db.commit()
+        finally:
+          db.close()
+        _pool = pool
+  return _pool
+
+def checkout_connection():     # Takes a connection from the pool and health checks it, reopening connections the server has dropped (e.g. after wait_timeout)
+  try:
+    db = get_pool().get_connection()
+  except Exception:
+    metrics.db_errors.inc("connect")
+    raise
+  try:
+    db.ping(reconnect=True, attempts=3, delay=1)
+  except Exception:
+    metrics.db_errors.inc("connect")
+    db.close()
+    raise
+  return db
+
+@contextmanager
+def get_connection():     # Borrows a pooled connection, checks it is still alive, and always hands it back to the pool
+  started = time.perf_counter()
+  if not _pool_slots.acquire(timeout=pool_timeout):
+    metrics.db_errors.inc("pool_timeout")
+    raise PoolTimeoutError(msg=f"No database connection available after {pool_timeout} seconds")
+  metrics.db_connections_in_use.inc()
+  try:
+    db = checkout_connection()
+    metrics.db_connect_duration.observe(time.perf_counter() - started)
+    try:
+      yield db
+    finally:
+      db.close()     # For pooled connections this returns the connection to the pool rather than closing it
+  finally:
+    metrics.db_connections_in_use.dec()
+    _pool_slots.release()
+
+@contextmanager
+def get_cursor(commit: bool = False):     # Yields a cursor on a pooled connection, committing on success or rolling back on any error
+  with get_connection() as db:
+    cursor = db.cursor()
+    try:
+      yield TimedCursor(cursor)
+      if commit:
+        with metrics.db_commit_duration.time():
+          try:
+            db.commit()
+          except Exception:
+            metrics.db_errors.inc("commit")
+            raise
+    except Exception:
+      db.rollback()
+      raise
+    finally:
+      cursor.close()
+
+def create_missing_tables(*tables: str) -> None:    # Creates the given tables from their definitions in init_db.sql if they do not exist yet, leaving existing tables and their data alone (init_db.py drops every table first)
+  with get_cursor(commit=True) as cursor:
+    for statement in create_table_statements(tables):
+      cursor.execute(statement)
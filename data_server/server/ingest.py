@@ -0,0 +1,197 @@
+import os
+import time
+import threading
+from datetime import datetime
+from db import get_cursor, ROW_ERRORS
+from catalog import update_catalog, invalidate_periodic, invalidate_historical, fetch_compacted_until
+from retention import retention_worker
+from live import hub
+import metrics
+
+batch_size = int(os.environ.get('INGEST_BATCH_SIZE', 200))              # Rows buffered before a flush is triggered early
+flush_interval = float(os.environ.get('INGEST_FLUSH_INTERVAL', 2))      # Maximum seconds a row waits in the buffer before it is written
+max_pending = int(os.environ.get('INGEST_MAX_PENDING', 10000))          # Rows held in memory before new samples are refused (backpressure)
+max_bulk = int(os.environ.get('INGEST_MAX_BULK', 1000))                # Samples accepted in one bulk request or MQTT message (never more than the buffer can hold)
+
+PERIODIC_COLUMNS = ("appliance_name", "local_time", "current_power", "distance_ultrasonic", "distance_bluetooth", "distance_ultrawideband", "user_presence_detected")
+HISTORICAL_COLUMNS = ("appliance_name", "local_time", "today_runtime", "month_runtime", "today_energy", "month_energy")
+INTEGER_RANGE = (-2**31, 2**31 - 1)     # Values the INTEGER columns of the data server can hold
+
+def parse_local_time(value) -> datetime:     # Accepts the "YYYY-MM-DD HH:MM:SS" strings sent by the ESP32s (or ISO 8601), times with an offset are converted to the server's local time
+  if not isinstance(value, datetime):
+    value = datetime.fromisoformat(str(value).strip())
+  if value.tzinfo is not None:
+    value = value.astimezone().replace(tzinfo=None)     # The tables hold naive local times, mixing in aware ones breaks every comparison
+  if value.year < 1000:
+    raise ValueError("year must be 1000 or later")      # Earliest DATETIME MariaDB accepts
+  return value
+
+def parse_integer(value) -> int:
+  number = int(value)
+  if not INTEGER_RANGE[0] <= number <= INTEGER_RANGE[1]:
+    raise ValueError(f"{number} does not fit in an INTEGER column")
+  return number
+
+def _check_sample(sample: dict, columns: tuple) -> str:    # Checks the fields shared by every sample type and returns the appliance name
+  if not isinstance(sample, dict):
+    raise ValueError("Measurement must be a JSON object")
+  missing = [column for column in columns if column not in sample]
+  if missing:
+    raise ValueError(f"Missing fields: {', '.join(missing)}")
+  appliance_name = str(sample['appliance_name'])
+  if not appliance_name or len(appliance_name) > 50:
+    raise ValueError("appliance_name must be between 1 and 50 characters")
+  return appliance_name
+
+def parse_periodic_sample(sample: dict) -> tuple:    # Validates one periodic measurement and converts it into a row for ShutEyeDeviceEnergyDataPeriodicMeasurement
+  appliance_name = _check_sample(sample, PERIODIC_COLUMNS)
+  try:
+    return (appliance_name,
+            parse_local_time(sample['local_time']),
+            parse_integer(sample['current_power']),
+            parse_integer(sample['distance_ultrasonic']),
+            parse_integer(sample['distance_bluetooth']),
+            parse_integer(sample['distance_ultrawideband']),
+            bool(sample['user_presence_detected']))
+  except (TypeError, ValueError) as err:
+    raise ValueError(f"Invalid periodic measurement: {err}")
+
+def parse_historical_sample(sample: dict) -> tuple:    # Validates one historical record and converts it into a row for ShutEyeDeviceEnergyDataHistorical
+  appliance_name = _check_sample(sample, HISTORICAL_COLUMNS)
+  try:
+    return (appliance_name,
+            parse_local_time(sample['local_time']),
+            parse_integer(sample['today_runtime']),
+            parse_integer(sample['month_runtime']),
+            parse_integer(sample['today_energy']),
+            parse_integer(sample['month_energy']))
+  except (TypeError, ValueError) as err:
+    raise ValueError(f"Invalid historical data: {err}")
+
+def insert_rows(cursor, table: str, columns: tuple, rows: list, chunk_size: int = 500) -> None:    # Writes rows as multi-row inserts, silently skipping (appliance_name, local_time) keys that already exist
+  placeholders = "(" + ", ".join(["%s"] * len(columns)) + ")"
+  for start in range(0, len(rows), chunk_size):
+    chunk = rows[start:start + chunk_size]
+    query = (f"insert into {table}(" + ", ".join(columns) + ") values "
+             + ", ".join([placeholders] * len(chunk))
+             + " on duplicate key update appliance_name = appliance_name")
+    cursor.execute(query, [value for row in chunk for value in row])
+
+def has_late_rows(rows: list) -> bool:    # Whether any periodic row is older than its appliance's compacted_until watermark, i.e. its day was compacted before it arrived
+  oldest = {}
+  for row in rows:
+    oldest[row[0]] = min(oldest.get(row[0], row[1]), row[1])
+  for appliance_name, local_time in oldest.items():
+    compacted_until = fetch_compacted_until(appliance_name)
+    if compacted_until is not None and local_time < compacted_until:
+      return True
+  return False
+
+def insert_periodic_rows(rows: list) -> None:    # Inserts the rows and updates the appliance catalog in one transaction, then invalidates the cached lookups they affect and pushes the rows to live clients
+  late = has_late_rows(rows)
+  with get_cursor(commit=True) as cursor:
+    insert_rows(cursor, "ShutEyeDeviceEnergyDataPeriodicMeasurement", PERIODIC_COLUMNS, rows)
+    update_catalog(cursor, rows)
+  invalidate_periodic(row[0] for row in rows)
+  hub.publish("periodic", PERIODIC_COLUMNS, rows)
+  if late:     # Reads before compacted_until only see the archive, so compact the late rows into it now rather than at the next scheduled run
+    retention_worker.wake()
+
+def insert_historical_rows(rows: list) -> None:
+  with get_cursor(commit=True) as cursor:
+    insert_rows(cursor, "ShutEyeDeviceEnergyDataHistorical", HISTORICAL_COLUMNS, rows)
+  invalidate_historical(row[0] for row in rows)
+  hub.publish("historical", HISTORICAL_COLUMNS, rows)
+
+class WriteBehindBuffer:     # Collects rows from every device and writes them in batches from a background thread, flushing by size or by time
+  def __init__(self, flush_rows, kind: str, batch_size: int = batch_size, flush_interval: float = flush_interval, max_pending: int = max_pending):
+    self.flush_rows = flush_rows
+    self.kind = kind     # "periodic" or "historical", labels this buffer's metrics
+    self.batch_size = batch_size
+    self.flush_interval = flush_interval
+    self.max_pending = max_pending
+    self._rows = []
+    self._lock = threading.Lock()
+    self._flush_lock = threading.Lock()
+    self._wake = threading.Event()
+    self._stopped = threading.Event()
+    self._thread = None
+
+  def start(self) -> None:
+    if self._thread is None:
+      self._stopped.clear()
+      self._thread = threading.Thread(target=self._run, name=f"write-behind-{self.kind}", daemon=True)
+      self._thread.start()
+
+  def stop(self) -> None:     # Stops the background thread and writes out anything still buffered
+    self._stopped.set()
+    self._wake.set()
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+    self.flush()
+
+  def pending(self) -> int:
+    with self._lock:
+      return len(self._rows)
+
+  def add(self, rows: list) -> bool:    # Queues rows for writing, returns False without queueing anything if the buffer is full
+    with self._lock:
+      if len(self._rows) + len(rows) > self.max_pending:
+        return False     # Callers count the samples in ingest_rejected once they give up on them, not on every attempt
+      self._rows.extend(rows)
+      if len(self._rows) >= self.batch_size:
+        self._wake.set()
+    metrics.record_samples(self.kind, rows)
+    return True
+
+  def flush(self) -> None:
+    with self._flush_lock:
+      with self._lock:
+        rows, self._rows = self._rows, []
+      if not rows:
+        return
+      started = time.perf_counter()
+      try:
+        retry = self._write(rows)
+      finally:
+        metrics.ingest_flush_duration.observe(time.perf_counter() - started, self.kind)
+      if retry:
+        with self._lock:     # Put the rows back in front of newer ones so they are retried on the next flush, dropping the oldest if that would overflow the buffer
+          dropped = len(retry) + len(self._rows) - self.max_pending
+          self._rows = (retry + self._rows)[-self.max_pending:]
+        if dropped > 0:
+          metrics.ingest_dropped_rows.inc(self.kind, amount=dropped)
+
+  def _write(self, rows: list) -> list:    # Writes rows and returns those to retry; a batch failing because of its values is split in halves until the bad rows are found and discarded
+    try:
+      self.flush_rows(rows)
+    except ROW_ERRORS as err:
+      if len(rows) == 1:
+        print("Write-behind discarded {0} row {1}: {2}".format(self.kind, rows[0], err))
+        metrics.ingest_discarded_rows.inc(self.kind)
+        return []
+      middle = len(rows) // 2
+      retry = self._write(rows[:middle])
+      if retry:     # The database became unavailable meanwhile, keep the other half for the next flush as well
+        return retry + rows[middle:]
+      return self._write(rows[middle:])
+    except Exception as err:     # Anything else (lost connection, busy pool, lock wait timeout, deadlock, tables not created yet) is retried, the devices were already told their samples were accepted
+      print("Write-behind flush of {0} rows failed, retrying later: {1}".format(len(rows), err))
+      metrics.ingest_flush_failures.inc(self.kind)
+      metrics.ingest_failed_rows.inc(self.kind, amount=len(rows))
+      return rows
+    metrics.ingest_flushed_rows.inc(self.kind, amount=len(rows))
+    return []
+
+  def _run(self) -> None:
+    while not self._stopped.is_set():
+      self._wake.wait(self.flush_interval)
+      self._wake.clear()
+      self.flush()
+
+periodic_buffer = WriteBehindBuffer(insert_periodic_rows, "periodic")
+historical_buffer = WriteBehindBuffer(insert_historical_rows, "historical")
+
+metrics.registry.register(metrics.Gauge("shuteye_ingest_pending_rows", "Rows waiting in the write-behind buffers", ("kind",),
+                                        lambda: {(buffer.kind,): buffer.pending() for buffer in (periodic_buffer, historical_buffer)}))
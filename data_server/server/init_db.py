@@ -47,5 +47,84 @@ try:
 except RuntimeError as err:
     print("Runtime error: {0}".format(err))
 
+cursor.execute("DROP TABLE IF EXISTS ShutEyeApplianceCatalog")  # Creates the catalog of appliances with periodic data, maintained by the insert routes
+try:
+    cursor.execute("""
+    CREATE TABLE ShutEyeApplianceCatalog (
+        appliance_name     VARCHAR(50) NOT NULL,
+        first_seen         DATETIME NOT NULL,
+        last_seen          DATETIME NOT NULL,
+        compacted_until    DATETIME NULL,
+        PRIMARY KEY (appliance_name)
+    );
+    """)
+except RuntimeError as err:
+    print("Runtime error: {0}".format(err))
+
+cursor.execute("DROP TABLE IF EXISTS ShutEyeApplianceActiveDates")  # Creates the table of dates each appliance has periodic data for, maintained by the insert routes
+try:
+    cursor.execute("""
+    CREATE TABLE ShutEyeApplianceActiveDates (
+        appliance_name     VARCHAR(50) NOT NULL,
+        active_date        DATE NOT NULL,
+        PRIMARY KEY (appliance_name, active_date)
+    );
+    """)
+except RuntimeError as err:
+    print("Runtime error: {0}".format(err))
+
+cursor.execute("DROP TABLE IF EXISTS ShutEyeDeviceEnergyDataMinute")  # Creates the table of per minute rollups of periodic data compacted by retention.py
+try:
+    cursor.execute("""
+    CREATE TABLE ShutEyeDeviceEnergyDataMinute (
+        appliance_name             VARCHAR(50) NOT NULL,
+        bucket_start               DATETIME NOT NULL,
+        sample_count               INTEGER NOT NULL,
+        energy                     BIGINT NOT NULL,
+        presence_energy            BIGINT NOT NULL,
+        covered_seconds            INTEGER NOT NULL,
+        presence_seconds           INTEGER NOT NULL,
+        min_distance_ultrasonic    INTEGER NOT NULL,
+        max_distance_ultrasonic    INTEGER NOT NULL,
+        avg_distance_ultrasonic    FLOAT NOT NULL,
+        min_distance_bluetooth     INTEGER NOT NULL,
+        max_distance_bluetooth     INTEGER NOT NULL,
+        avg_distance_bluetooth     FLOAT NOT NULL,
+        min_distance_ultrawideband INTEGER NOT NULL,
+        max_distance_ultrawideband INTEGER NOT NULL,
+        avg_distance_ultrawideband FLOAT NOT NULL,
+        PRIMARY KEY (appliance_name, bucket_start),
+        KEY (bucket_start)
+    );
+    """)
+except RuntimeError as err:
+    print("Runtime error: {0}".format(err))
+
+cursor.execute("DROP TABLE IF EXISTS ShutEyeDeviceEnergyDataHourly")  # Creates the table of per hour rollups of periodic data compacted by retention.py
+try:
+    cursor.execute("""
+    CREATE TABLE ShutEyeDeviceEnergyDataHourly (
+        appliance_name             VARCHAR(50) NOT NULL,
+        bucket_start               DATETIME NOT NULL,
+        sample_count               INTEGER NOT NULL,
+        energy                     BIGINT NOT NULL,
+        presence_energy            BIGINT NOT NULL,
+        covered_seconds            INTEGER NOT NULL,
+        presence_seconds           INTEGER NOT NULL,
+        min_distance_ultrasonic    INTEGER NOT NULL,
+        max_distance_ultrasonic    INTEGER NOT NULL,
+        avg_distance_ultrasonic    FLOAT NOT NULL,
+        min_distance_bluetooth     INTEGER NOT NULL,
+        max_distance_bluetooth     INTEGER NOT NULL,
+        avg_distance_bluetooth     FLOAT NOT NULL,
+        min_distance_ultrawideband INTEGER NOT NULL,
+        max_distance_ultrawideband INTEGER NOT NULL,
+        avg_distance_ultrawideband FLOAT NOT NULL,
+        PRIMARY KEY (appliance_name, bucket_start)
+    );
+    """)
+except RuntimeError as err:
+    print("Runtime error: {0}".format(err))
+
 db.commit()   # Commits the changes to the database and closes the connection
 db.close()
\ No newline at end of file
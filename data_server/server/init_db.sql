@@ -25,3 +25,66 @@ CREATE TABLE ShutEyeDeviceEnergyDataPeriodicMeasurement (
     user_presence_detected   BOOLEAN NOT NULL,
     PRIMARY KEY (appliance_name, local_time)
 );
+
+DROP TABLE IF EXISTS ShutEyeApplianceCatalog;
+
+CREATE TABLE ShutEyeApplianceCatalog (
+    appliance_name     VARCHAR(50) NOT NULL,
+    first_seen         DATETIME NOT NULL,
+    last_seen          DATETIME NOT NULL,
+    compacted_until    DATETIME NULL,
+    PRIMARY KEY (appliance_name)
+);
+
+DROP TABLE IF EXISTS ShutEyeApplianceActiveDates;
+
+CREATE TABLE ShutEyeApplianceActiveDates (
+    appliance_name     VARCHAR(50) NOT NULL,
+    active_date        DATE NOT NULL,
+    PRIMARY KEY (appliance_name, active_date)
+);
+
+DROP TABLE IF EXISTS ShutEyeDeviceEnergyDataMinute;
+
+CREATE TABLE ShutEyeDeviceEnergyDataMinute (
+    appliance_name             VARCHAR(50) NOT NULL,
+    bucket_start               DATETIME NOT NULL,
+    sample_count               INTEGER NOT NULL,
+    energy                     BIGINT NOT NULL,
+    presence_energy            BIGINT NOT NULL,
+    covered_seconds            INTEGER NOT NULL,
+    presence_seconds           INTEGER NOT NULL,
+    min_distance_ultrasonic    INTEGER NOT NULL,
+    max_distance_ultrasonic    INTEGER NOT NULL,
+    avg_distance_ultrasonic    FLOAT NOT NULL,
+    min_distance_bluetooth     INTEGER NOT NULL,
+    max_distance_bluetooth     INTEGER NOT NULL,
+    avg_distance_bluetooth     FLOAT NOT NULL,
+    min_distance_ultrawideband INTEGER NOT NULL,
+    max_distance_ultrawideband INTEGER NOT NULL,
+    avg_distance_ultrawideband FLOAT NOT NULL,
+    PRIMARY KEY (appliance_name, bucket_start),
+    KEY (bucket_start)
+);
+
+DROP TABLE IF EXISTS ShutEyeDeviceEnergyDataHourly;
+
+CREATE TABLE ShutEyeDeviceEnergyDataHourly (
+    appliance_name             VARCHAR(50) NOT NULL,
+    bucket_start               DATETIME NOT NULL,
+    sample_count               INTEGER NOT NULL,
+    energy                     BIGINT NOT NULL,
+    presence_energy            BIGINT NOT NULL,
+    covered_seconds            INTEGER NOT NULL,
+    presence_seconds           INTEGER NOT NULL,
+    min_distance_ultrasonic    INTEGER NOT NULL,
+    max_distance_ultrasonic    INTEGER NOT NULL,
+    avg_distance_ultrasonic    FLOAT NOT NULL,
+    min_distance_bluetooth     INTEGER NOT NULL,
+    max_distance_bluetooth     INTEGER NOT NULL,
+    avg_distance_bluetooth     FLOAT NOT NULL,
+    min_distance_ultrawideband INTEGER NOT NULL,
+    max_distance_ultrawideband INTEGER NOT NULL,
+    avg_distance_ultrawideband FLOAT NOT NULL,
+    PRIMARY KEY (appliance_name, bucket_start)
+);
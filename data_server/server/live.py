@@ -0,0 +1,88 @@
+import os
+import asyncio
+import threading
+import metrics
+
+queue_size = int(os.environ.get('LIVE_QUEUE_SIZE', 100))               # Messages held per connected client before its oldest are dropped
+max_subscribers = int(os.environ.get('LIVE_MAX_SUBSCRIBERS', 100))     # Connected live clients allowed at once
+keepalive_interval = float(os.environ.get('LIVE_KEEPALIVE', 15))       # Seconds of silence before a keepalive is sent, so proxies do not close idle streams
+
+class Subscriber:     # One connected client; messages are handed over to its event loop and its queue drops the oldest message when full
+  def __init__(self, appliance_name: str, loop: asyncio.AbstractEventLoop, maxsize: int = queue_size):
+    self.appliance_name = appliance_name
+    self.loop = loop
+    self.queue = asyncio.Queue(maxsize)
+    self.dropped = 0     # Messages dropped since the client was last told, so it knows to re-fetch what it missed
+
+  def offer(self, message: dict) -> None:    # Called from any thread
+    try:
+      self.loop.call_soon_threadsafe(self._put, message)
+    except RuntimeError:     # The client's event loop has already closed
+      pass
+
+  def _put(self, message: dict) -> None:
+    if self.queue.full():
+      self.queue.get_nowait()
+      self.dropped += 1
+    self.queue.put_nowait(message)
+
+  async def next(self, timeout: float = keepalive_interval):    # Waits for the next message, returning None on timeout so the caller can send a keepalive
+    try:
+      return await asyncio.wait_for(self.queue.get(), timeout)
+    except asyncio.TimeoutError:
+      return None
+
+  def take_dropped(self) -> int:
+    dropped, self.dropped = self.dropped, 0
+    return dropped
+
+class BroadcastHub:     # Fans newly ingested records out to the clients subscribed to their appliance
+  def __init__(self, max_subscribers: int = max_subscribers):
+    self.max_subscribers = max_subscribers
+    self._subscribers = {}
+    self._count = 0
+    self._lock = threading.Lock()
+
+  def subscribe(self, appliance_name: str, loop: asyncio.AbstractEventLoop):    # Returns None when the server already has max_subscribers clients
+    with self._lock:
+      if self._count >= self.max_subscribers:
+        return None
+      subscriber = Subscriber(appliance_name, loop)
+      self._subscribers.setdefault(appliance_name, set()).add(subscriber)
+      self._count += 1
+      return subscriber
+
+  def unsubscribe(self, subscriber: Subscriber) -> None:
+    with self._lock:
+      subscribers = self._subscribers.get(subscriber.appliance_name)
+      if subscribers is not None and subscriber in subscribers:
+        subscribers.remove(subscriber)
+        self._count -= 1
+        if not subscribers:
+          del self._subscribers[subscriber.appliance_name]
+
+  def publish(self, kind: str, columns: tuple, rows: list) -> None:    # Sends each row to the subscribers of its appliance, building the JSON only for rows someone is listening to
+    with self._lock:
+      if not self._subscribers:
+        return
+      targets = {appliance_name: list(subscribers) for appliance_name, subscribers in self._subscribers.items()}
+    for row in rows:
+      subscribers = targets.get(row[0])
+      if subscribers:
+        message = {"type": kind, "data": row_to_dict(columns, row)}
+        for subscriber in subscribers:
+          subscriber.offer(message)
+
+def row_to_dict(columns: tuple, row: tuple) -> dict:    # Same JSON shape the REST routes return for a row
+  record = {}
+  for column, value in zip(columns, row):
+    if column == "local_time":
+      value = value.strftime("%Y-%m-%d %H:%M:%S")
+    elif isinstance(value, bool):
+      value = int(value)     # The database returns BOOLEAN columns as 0/1
+    record[column] = value
+  return record
+
+hub = BroadcastHub()
+
+metrics.registry.register(metrics.Gauge("shuteye_live_subscribers", "Clients connected to the live SSE and WebSocket streams", function=lambda: hub._count))
@@ -0,0 +1,221 @@
+import os
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Minimal in-process Prometheus metrics, rendered in the text exposition format by the /metrics route in server.py.
+# Each observation is a dict lookup and a few additions under a per-metric lock, cheap enough to leave on in production
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)     # Seconds, for HTTP requests and database calls
+LAG_BUCKETS = (1, 2.5, 5, 10, 30, 60, 300, 900, 3600, 21600, 86400)                            # Seconds between a sample's local_time and its arrival
+
+max_appliances = int(os.environ.get('METRICS_MAX_APPLIANCES', 200))     # Appliances given their own per appliance series, samples from any others are counted together
+OTHER_APPLIANCES = "(other)"     # appliance_name label for samples beyond max_appliances
+
+def _escape(value) -> str:
+  return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+  pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+  if extra:
+    pairs.append(extra)
+  return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+  return repr(float(value)) if value != int(value) else str(int(value))
+
+class Metric:     # Base for a metric family whose series are keyed by a tuple of label values
+  kind = "untyped"
+
+  def __init__(self, name: str, documentation: str, labels: tuple = ()):
+    self.name = name
+    self.documentation = documentation
+    self.labels = labels
+    self._values = {}
+    self._lock = threading.Lock()
+
+  def render(self) -> list:
+    lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+    with self._lock:
+      series = sorted(self._values.items())
+    for label_values, value in series:
+      lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {_format_value(value)}")
+    return lines
+
+class Counter(Metric):
+  kind = "counter"
+
+  def inc(self, *label_values, amount: float = 1) -> None:
+    with self._lock:
+      self._values[label_values] = self._values.get(label_values, 0) + amount
+
+class Gauge(Metric):     # Set directly, or computed when scraped by a function returning the value (or a dict of label values -> value)
+  kind = "gauge"
+
+  def __init__(self, name: str, documentation: str, labels: tuple = (), function=None):
+    super().__init__(name, documentation, labels)
+    self.function = function
+
+  def set(self, *label_values, value: float) -> None:
+    with self._lock:
+      self._values[label_values] = value
+
+  def inc(self, *label_values, amount: float = 1) -> None:
+    with self._lock:
+      self._values[label_values] = self._values.get(label_values, 0) + amount
+
+  def dec(self, *label_values, amount: float = 1) -> None:
+    self.inc(*label_values, amount=-amount)
+
+  def render(self) -> list:
+    if self.function is not None:
+      values = self.function()
+      with self._lock:
+        self._values = dict(values) if isinstance(values, dict) else {(): values}
+    return super().render()
+
+class Histogram(Metric):     # Per series: a count per bucket (cumulated when rendered), the sum and the total count
+  kind = "histogram"
+
+  def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+    super().__init__(name, documentation, labels)
+    self.buckets = tuple(buckets)
+
+  def observe(self, value: float, *label_values) -> None:
+    self.observe_many((value,), *label_values)
+
+  def observe_many(self, values, *label_values) -> None:    # Records several observations of one series under a single lock acquisition
+    with self._lock:
+      series = self._values.get(label_values)
+      if series is None:
+        series = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+      for value in values:
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+  @contextmanager
+  def time(self, *label_values):    # Observes the duration of the with block, including when it raises
+    started = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.observe(time.perf_counter() - started, *label_values)
+
+  def render(self) -> list:
+    lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+    with self._lock:
+      series = sorted((label_values, (list(counts), total, count)) for label_values, (counts, total, count) in self._values.items())
+    for label_values, (counts, total, count) in series:
+      cumulative = 0
+      for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+        cumulative += bucket_count
+        le = 'le="+Inf"' if bound == float("inf") else f'le="{_format_value(bound)}"'
+        lines.append(f"{self.name}_bucket{_format_labels(self.labels, label_values, le)} {cumulative}")
+      lines.append(f"{self.name}_sum{_format_labels(self.labels, label_values)} {_format_value(total)}")
+      lines.append(f"{self.name}_count{_format_labels(self.labels, label_values)} {count}")
+    return lines
+
+class Registry:
+  def __init__(self):
+    self._metrics = []
+
+  def register(self, metric: Metric) -> Metric:
+    self._metrics.append(metric)
+    return metric
+
+  def render(self) -> str:
+    lines = []
+    for metric in self._metrics:
+      try:
+        lines += metric.render()
+      except Exception as err:     # A failing gauge function must not take the rest of the scrape down
+        print("Rendering metric {0} failed: {1}".format(metric.name, err))
+    return "\n".join(lines) + "\n"
+
+registry = Registry()
+_appliances = set()
+_appliances_lock = threading.Lock()
+
+http_requests = registry.register(Counter("shuteye_http_requests_total", "HTTP requests handled, by route template and status code", ("method", "route", "status")))
+http_request_duration = registry.register(Histogram("shuteye_http_request_duration_seconds", "Time until the response headers were sent, by route template", ("method", "route")))
+
+db_connect_duration = registry.register(Histogram("shuteye_db_connect_seconds", "Time to borrow and health check a pooled database connection, including waiting for a free one"))
+db_query_duration = registry.register(Histogram("shuteye_db_query_seconds", "Time spent executing statements, by statement type", ("statement",)))
+db_fetch_duration = registry.register(Histogram("shuteye_db_fetch_seconds", "Time spent fetching result rows"))
+db_commit_duration = registry.register(Histogram("shuteye_db_commit_seconds", "Time spent committing transactions"))
+db_errors = registry.register(Counter("shuteye_db_errors_total", "Database calls that raised, by the operation that failed", ("operation",)))
+db_connections_in_use = registry.register(Gauge("shuteye_db_connections_in_use", "Pooled database connections currently borrowed"))
+
+ingest_samples = registry.register(Counter("shuteye_ingest_samples_total", "Samples accepted into the write-behind buffers, by kind and appliance", ("kind", "appliance_name")))
+ingest_last_seen = registry.register(Gauge("shuteye_ingest_last_seen_timestamp_seconds", "Unix time the latest sample from the appliance was received", ("kind", "appliance_name")))
+ingest_last_lag = registry.register(Gauge("shuteye_ingest_last_sample_lag_seconds", "Receive time minus local_time of the latest sample from the appliance (negative if the device clock is ahead)", ("kind", "appliance_name")))
+ingest_lag = registry.register(Histogram("shuteye_ingest_sample_lag_seconds", "Receive time minus the local_time in the sample payload", ("kind",), LAG_BUCKETS))
+ingest_rejected = registry.register(Counter("shuteye_ingest_rejected_samples_total", "Samples refused because the write-behind buffer was full", ("kind",)))
+ingest_flush_duration = registry.register(Histogram("shuteye_ingest_flush_seconds", "Time to write one batch from the write-behind buffer", ("kind",)))
+ingest_flushed_rows = registry.register(Counter("shuteye_ingest_flushed_rows_total", "Rows written by the write-behind buffers", ("kind",)))
+ingest_flush_failures = registry.register(Counter("shuteye_ingest_flush_failures_total", "Batch inserts that failed for a reason other than the rows written (e.g. a lost connection) and were queued for retry", ("kind",)))
+ingest_failed_rows = registry.register(Counter("shuteye_ingest_failed_rows_total", "Rows in batch inserts that failed and were queued for retry", ("kind",)))
+ingest_discarded_rows = registry.register(Counter("shuteye_ingest_discarded_rows_total", "Rows discarded because the database rejected their values", ("kind",)))
+ingest_dropped_rows = registry.register(Counter("shuteye_ingest_dropped_rows_total", "Rows dropped because the buffer overflowed while retrying a failed insert", ("kind",)))
+mqtt_rejected = registry.register(Counter("shuteye_mqtt_rejected_messages_total", "MQTT messages rejected, by reason", ("reason",)))
+
+def route_label(scope: dict, root_path: str) -> str:    # The matched route template (or mount path), so paths with appliance names in them do not each get their own series
+  route = scope.get("route")
+  if route is not None:
+    return route.path
+  if scope.get("root_path", "") != root_path:     # Mounts such as /static extend root_path instead of setting the route
+    return scope["root_path"] + "/{path}"
+  return "unmatched"
+
+class MetricsMiddleware:     # ASGI middleware timing each HTTP request up to its response headers, so streamed responses are measured to their first byte
+  def __init__(self, app):
+    self.app = app
+
+  async def __call__(self, scope, receive, send):
+    if scope["type"] != "http":
+      await self.app(scope, receive, send)
+      return
+    started = time.perf_counter()
+    root_path = scope.get("root_path", "")
+    status = [500]     # Reported if the app raises before sending a response
+
+    async def send_timed(message):
+      if message["type"] == "http.response.start":
+        status[0] = message["status"]
+        http_request_duration.observe(time.perf_counter() - started, scope["method"], route_label(scope, root_path))
+      await send(message)
+
+    try:
+      await self.app(scope, receive, send_timed)
+    finally:
+      http_requests.inc(scope["method"], route_label(scope, root_path), str(status[0]))
+
+def appliance_label(appliance_name: str) -> str:    # Appliance names come from unauthenticated payloads, so only the first max_appliances seen get their own series
+  if appliance_name in _appliances:
+    return appliance_name
+  with _appliances_lock:
+    if len(_appliances) < max_appliances:
+      _appliances.add(appliance_name)
+      return appliance_name
+  return OTHER_APPLIANCES
+
+def record_samples(kind: str, rows: list) -> None:    # Counts samples accepted for ingest and tracks per appliance arrival and lag, rows start with (appliance_name, local_time)
+  try:
+    now = time.time()     # local_time is naive device wall clock time, which timestamp() reads in the server's time zone
+    latest = {}
+    lags = []
+    for row in rows:
+      appliance_name, local_time = appliance_label(row[0]), row[1].timestamp()
+      lags.append(max(0.0, now - local_time))     # A device clock running ahead shows in the per appliance gauge, not the histogram
+      count, newest = latest.get(appliance_name, (0, local_time))
+      latest[appliance_name] = (count + 1, max(newest, local_time))
+  except Exception as err:     # Metrics must never fail an ingest that has already been accepted
+    print("Recording {0} ingest metrics failed: {1}".format(kind, err))
+    return
+  ingest_lag.observe_many(lags, kind)
+  for appliance_name, (count, newest) in latest.items():
+    ingest_samples.inc(kind, appliance_name, amount=count)
+    ingest_last_seen.set(kind, appliance_name, value=now)
+    ingest_last_lag.set(kind, appliance_name, value=now - newest)
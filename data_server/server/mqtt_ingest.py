@@ -0,0 +1,112 @@
+import os
+import json
+import time
+import paho.mqtt.client as mqtt
+from ingest import parse_periodic_sample, parse_historical_sample, periodic_buffer, historical_buffer, max_bulk
+import metrics
+
+mqtt_host = os.environ.get('MQTT_HOST', '')                 # MQTT ingest is only started when a broker is configured
+mqtt_port = int(os.environ.get('MQTT_PORT', 1883))
+mqtt_username = os.environ.get('MQTT_USERNAME', '')
+mqtt_password = os.environ.get('MQTT_PASSWORD', '')
+mqtt_client_id = os.environ.get('MQTT_CLIENT_ID', 'shuteye-data-server')
+mqtt_topic_prefix = os.environ.get('MQTT_TOPIC_PREFIX', 'shuteye')
+mqtt_qos = int(os.environ.get('MQTT_QOS', 1))
+backpressure_timeout = float(os.environ.get('MQTT_BACKPRESSURE_TIMEOUT', 30))    # Seconds a message waits for room in the ingest buffer before it is dropped
+
+PARSERS = {     # Topic suffix -> (validation function, write-behind buffer), the same path the REST routes use
+  "periodic": (parse_periodic_sample, periodic_buffer),
+  "historical": (parse_historical_sample, historical_buffer),
+}
+
+_client = None
+_manual_ack = False     # Whether the client leaves acknowledging QoS 1 messages to on_message (paho-mqtt 2.x)
+
+def topics() -> list:    # Topics are shuteye/<appliance>/periodic and shuteye/<appliance>/historical
+  return [(f"{mqtt_topic_prefix}/+/{kind}", mqtt_qos) for kind in PARSERS]
+
+def handle_message(topic: str, payload: bytes) -> int:    # Validates an MQTT message (one JSON sample or an array of them) and queues the rows, returns the number of rows queued
+  parts = topic.split("/")
+  if len(parts) != 3 or parts[0] != mqtt_topic_prefix or parts[2] not in PARSERS:
+    raise ValueError(f"Unexpected topic {topic}")
+  appliance_name, kind = parts[1], parts[2]
+  parse_sample, buffer = PARSERS[kind]
+
+  try:
+    samples = json.loads(payload)
+  except (UnicodeDecodeError, json.JSONDecodeError) as err:
+    raise ValueError(f"Invalid JSON: {err}")
+  if not isinstance(samples, list):
+    samples = [samples]
+  if len(samples) > min(max_bulk, buffer.max_pending):
+    raise ValueError(f"{len(samples)} samples in one message, at most {min(max_bulk, buffer.max_pending)} are accepted")
+
+  rows = []
+  for sample in samples:
+    if isinstance(sample, dict):
+      if str(sample.setdefault("appliance_name", appliance_name)) != appliance_name:   # Devices may leave the appliance name out since it is already in the topic
+        raise ValueError(f"appliance_name {sample['appliance_name']} does not match topic {topic}")
+    rows.append(parse_sample(sample))
+
+  deadline = time.monotonic() + backpressure_timeout
+  while not buffer.add(rows):     # Blocking here stops the client reading from the socket, so the broker holds further messages instead of the Pi's memory
+    if time.monotonic() > deadline:
+      metrics.ingest_rejected.inc(buffer.kind, amount=len(rows))
+      raise RuntimeError(f"Ingest buffer full, dropped {len(rows)} rows from {topic}")
+    time.sleep(0.1)
+  return len(rows)
+
+def on_connect(client, userdata, flags, rc) -> None:    # (Re)subscribes every time the connection to the broker is established
+  if rc == 0:
+    client.subscribe(topics())
+  else:
+    print("MQTT connection refused: {0}".format(rc))
+
+def on_message(client, userdata, message) -> None:    # Errors are logged rather than raised (paho would re-raise them and stop the network loop)
+  acknowledge = True
+  try:
+    handle_message(message.topic, message.payload)
+  except ValueError as err:     # Invalid messages will never succeed, so they are acknowledged and dropped
+    print("MQTT message on {0} rejected: {1}".format(message.topic, err))
+    metrics.mqtt_rejected.inc("invalid")
+  except RuntimeError as err:
+    print("MQTT message on {0} rejected: {1}".format(message.topic, err))
+    metrics.mqtt_rejected.inc("buffer_full")
+    acknowledge = False
+  except Exception as err:
+    print("MQTT message on {0} failed: {1}".format(message.topic, err))
+    metrics.mqtt_rejected.inc("error")
+    acknowledge = False
+  if acknowledge and _manual_ack:     # Unacknowledged messages stay with the broker, which sends them again when the session resumes
+    client.ack(message.mid, message.qos)
+
+def create_client():
+  try:
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id=mqtt_client_id, clean_session=False)   # paho-mqtt 2.x
+  except AttributeError:
+    client = mqtt.Client(client_id=mqtt_client_id, clean_session=False)   # paho-mqtt 1.x
+  if mqtt_username:
+    client.username_pw_set(mqtt_username, mqtt_password)
+  client.max_inflight_messages_set(20)
+  client.reconnect_delay_set(min_delay=1, max_delay=60)
+  return client
+
+def start(client=None) -> None:    # Connects in the background so the server still starts while the broker is down, any paho-compatible client (e.g. a local stand-in) can be passed in
+  global _client, _manual_ack
+  if _client is not None or (client is None and not mqtt_host):
+    return
+  _client = client or create_client()
+  _manual_ack = hasattr(_client, "manual_ack_set")     # paho-mqtt 1.x acknowledges every message as on_message returns
+  if _manual_ack:
+    _client.manual_ack_set(True)
+  _client.on_connect = on_connect
+  _client.on_message = on_message
+  _client.connect_async(mqtt_host or "localhost", mqtt_port, keepalive=60)
+  _client.loop_start()
+
+def stop() -> None:
+  global _client
+  if _client is not None:
+    _client.disconnect()
+    _client.loop_stop()
+    _client = None
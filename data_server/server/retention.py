@@ -0,0 +1,201 @@
+import os
+import threading
+from datetime import datetime, date, timedelta, time
+from urllib.parse import quote
+import numpy as np
+from db import get_cursor, create_missing_tables, require_tables
+from cache import read_cache
+from aggregate import rollup
+
+raw_retention_days = int(os.environ.get('RAW_RETENTION_DAYS', 30))            # Days of raw 5 second samples kept in ShutEyeDeviceEnergyDataPeriodicMeasurement
+minute_retention_days = int(os.environ.get('MINUTE_RETENTION_DAYS', 365))     # Days of minute rollups kept, hour rollups are kept forever
+retention_interval = float(os.environ.get('RETENTION_INTERVAL', 3600))        # Seconds between retention runs while the server is up
+archive_dir = os.environ.get('ARCHIVE_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), "archive")   # Compacted raw samples are archived here, one compressed file per appliance per day
+
+ROLLUP_TABLES = {60: "ShutEyeDeviceEnergyDataMinute", 3600: "ShutEyeDeviceEnergyDataHourly"}    # Bucket length in seconds -> rollup table
+SENSORS = ("ultrasonic", "bluetooth", "ultrawideband")
+ROLLUP_COLUMNS = (("appliance_name", "bucket_start", "sample_count", "energy", "presence_energy", "covered_seconds", "presence_seconds")
+                  + tuple(f"{stat}_distance_{sensor}" for sensor in SENSORS for stat in ("min", "max", "avg")))
+ARCHIVE_COLUMNS = ("local_time", "current_power", "distance_ultrasonic", "distance_bluetooth", "distance_ultrawideband", "user_presence_detected")
+require_tables(*ROLLUP_TABLES.values())     # Databases initialized before the rollups existed get their tables
+
+def create_rollup_tables() -> None:    # Adds the rollup tables to a database initialized before they existed, without touching its data
+  create_missing_tables(*ROLLUP_TABLES.values())
+
+def archive_path(appliance_name: str, day) -> str:
+  return os.path.join(archive_dir, quote(appliance_name, safe=""), day.strftime("%Y-%m-%d") + ".npz")
+
+def write_archive(appliance_name: str, day, columns: dict) -> dict:    # Stores a day of raw samples as compressed NumPy columns, merging with (and de-duplicating against) an existing file for that day; returns the merged columns
+  path = archive_path(appliance_name, day)
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  if os.path.exists(path):
+    with np.load(path) as existing:
+      columns = {column: np.concatenate([existing[column], columns[column]]) for column in ARCHIVE_COLUMNS}
+    _, first = np.unique(columns["local_time"], return_index=True)    # Sorted by time, keeping the first copy of any sample archived twice
+    columns = {column: values[first] for column, values in columns.items()}
+  temporary_path = path + ".tmp"
+  with open(temporary_path, "wb") as archive:
+    np.savez_compressed(archive, **columns)
+    archive.flush()
+    os.fsync(archive.fileno())
+  os.replace(temporary_path, path)    # Readers never see a half written file
+  return columns
+
+def read_archive(appliance_name: str, start: datetime = None, end: datetime = None, after: datetime = None):    # Yields archived samples in [start, end) and after the after cursor, as periodic measurement table rows in time order
+  directory = os.path.join(archive_dir, quote(appliance_name, safe=""))
+  if not os.path.isdir(directory):
+    return
+  lower = max(bound for bound in (start, after) if bound is not None) if (start or after) else None
+  for name in sorted(os.listdir(directory)):
+    if not name.endswith(".npz"):
+      continue
+    day_start = datetime.strptime(name[:-4], "%Y-%m-%d")
+    if (lower is not None and day_start + timedelta(days=1) <= lower) or (end is not None and day_start >= end):
+      continue
+    with np.load(os.path.join(directory, name)) as archive:
+      columns = {column: archive[column] for column in ARCHIVE_COLUMNS}
+    keep = np.ones(len(columns["local_time"]), dtype=bool)
+    if start is not None:
+      keep &= columns["local_time"] >= np.datetime64(start, "s")
+    if after is not None:
+      keep &= columns["local_time"] > np.datetime64(after, "s")
+    if end is not None:
+      keep &= columns["local_time"] < np.datetime64(end, "s")
+    columns["user_presence_detected"] = columns["user_presence_detected"].astype(np.int64)    # Matches the 0/1 the database returns for BOOLEAN columns
+    values = [columns[column][keep].tolist() for column in ARCHIVE_COLUMNS]
+    for row in zip(*values):
+      yield (appliance_name,) + row
+
+def replace_rollups(cursor, table: str, appliance_name: str, start: datetime, end: datetime, rows: dict) -> None:    # Replaces the appliance's rollup rows for buckets in [start, end) with rows
+  cursor.execute(f"DELETE FROM {table} WHERE appliance_name = %s AND bucket_start >= %s AND bucket_start < %s;", (appliance_name, start, end))
+  columns = [[appliance_name] * len(rows["bucket_start"]), rows["bucket_start"].tolist(), rows["sample_count"].tolist(), rows["energy"].tolist(),
+             rows["presence_energy"].tolist(), rows["covered_seconds"].tolist(), rows["presence_seconds"].tolist()]
+  for index in range(len(SENSORS)):
+    columns += [rows["min_distance"][:, index].tolist(), rows["max_distance"][:, index].tolist(), rows["avg_distance"][:, index].tolist()]
+  records = list(zip(*columns))
+  if not records:
+    return
+  placeholders = "(" + ", ".join(["%s"] * len(ROLLUP_COLUMNS)) + ")"
+  query = f"insert into {table}(" + ", ".join(ROLLUP_COLUMNS) + ") values " + ", ".join([placeholders] * len(records))
+  cursor.execute(query, [value for record in records for value in record])
+
+def compact_day(appliance_name: str, day) -> int:    # Archives one day of raw samples, rebuilds the day's minute and hour rollups from the archive and deletes the samples, in one transaction; returns the rows compacted
+  day_start = datetime.combine(day, time())
+  day_end = day_start + timedelta(days=1)
+  with get_cursor(commit=True) as cursor:
+    cursor.execute("""
+      SELECT local_time, current_power, distance_ultrasonic, distance_bluetooth, distance_ultrawideband, user_presence_detected
+      FROM ShutEyeDeviceEnergyDataPeriodicMeasurement
+      WHERE appliance_name = %s AND local_time >= %s AND local_time < %s
+      ORDER BY local_time ASC
+      FOR UPDATE;
+    """, (appliance_name, day_start, day_end))    # Locks the range so a sample arriving meanwhile is not deleted without being archived
+    records = cursor.fetchall()
+    if records:
+      times, power, ultrasonic, bluetooth, ultrawideband, presence = zip(*records)
+      columns = {"local_time": np.array(times, dtype="datetime64[s]"), "current_power": np.array(power, dtype=np.int64),
+                 "distance_ultrasonic": np.array(ultrasonic, dtype=np.int64), "distance_bluetooth": np.array(bluetooth, dtype=np.int64),
+                 "distance_ultrawideband": np.array(ultrawideband, dtype=np.int64), "user_presence_detected": np.array(presence, dtype=bool)}
+      # Late samples for a day compacted before are merged into its archive, and the rollups are rebuilt from the whole merged day,
+      # so samples already counted (or sent twice) are not added to the buckets again
+      columns = write_archive(appliance_name, day, columns)
+      distances = np.column_stack([columns["distance_ultrasonic"], columns["distance_bluetooth"], columns["distance_ultrawideband"]])
+      for bucket_seconds, table in ROLLUP_TABLES.items():
+        replace_rollups(cursor, table, appliance_name, day_start, day_end,
+                        rollup(columns["local_time"], columns["current_power"], columns["user_presence_detected"], distances, bucket_seconds))
+      cursor.execute("DELETE FROM ShutEyeDeviceEnergyDataPeriodicMeasurement WHERE appliance_name = %s AND local_time >= %s AND local_time < %s;",
+                     (appliance_name, day_start, day_end))
+    set_compacted_until(cursor, appliance_name, day_end)
+  read_cache.invalidate(("compacted_until", appliance_name))
+  return len(records)
+
+def set_compacted_until(cursor, appliance_name: str, compacted_until: datetime) -> None:    # Moves the appliance's watermark forward; reads before it come from the archive and rollups
+  cursor.execute("UPDATE ShutEyeApplianceCatalog SET compacted_until = GREATEST(COALESCE(compacted_until, %s), %s) WHERE appliance_name = %s;",
+                 (compacted_until, compacted_until, appliance_name))
+
+def rollup_table(start: datetime, bucket_seconds: int, today: date = None):    # The rollup table whose buckets fall wholly inside summary buckets of bucket_seconds starting at start, None if no table still held fits
+  if bucket_seconds % 3600 == 0 and start == start.replace(minute=0, second=0, microsecond=0):
+    return ROLLUP_TABLES[3600]
+  minute_cutoff = datetime.combine((today or date.today()) - timedelta(days=minute_retention_days), time())    # Minute rollups before this have been expired
+  if bucket_seconds % 60 == 0 and start == start.replace(second=0, microsecond=0) and start >= minute_cutoff:
+    return ROLLUP_TABLES[60]
+  return None
+
+def fetch_rollups(appliance_name: str, start: datetime, end: datetime, bucket_seconds: int):    # Rollup columns for energy_summary(), or None if no rollup table fits the buckets (see rollup_table())
+  table = rollup_table(start, bucket_seconds)
+  if table is None:
+    return None
+  with get_cursor() as cursor:
+    cursor.execute(f"""
+      SELECT bucket_start, energy, presence_energy, covered_seconds, presence_seconds
+      FROM {table}
+      WHERE appliance_name = %s AND bucket_start >= %s AND bucket_start < %s
+      ORDER BY bucket_start ASC;
+    """, (appliance_name, start, end))
+    records = cursor.fetchall()
+  columns = ("bucket_start", "energy", "presence_energy", "covered_seconds", "presence_seconds")
+  return {column: [record[index] for record in records] for index, column in enumerate(columns)}
+
+def run_retention(now: datetime = None) -> int:    # Compacts every appliance's raw samples older than the retention window and expires old minute rollups; returns the rows compacted
+  create_rollup_tables()
+  today = (now or datetime.now()).date()
+  cutoff = datetime.combine(today - timedelta(days=raw_retention_days), time())
+  with get_cursor() as cursor:
+    cursor.execute("SELECT appliance_name FROM ShutEyeApplianceCatalog;")
+    appliance_names = [name[0] for name in cursor.fetchall()]
+
+  compacted = 0
+  for appliance_name in appliance_names:
+    while True:     # Jumps straight to the oldest remaining raw sample, so gaps in the data cost nothing
+      with get_cursor() as cursor:
+        cursor.execute("SELECT local_time FROM ShutEyeDeviceEnergyDataPeriodicMeasurement WHERE appliance_name = %s AND local_time < %s ORDER BY local_time ASC LIMIT 1;", (appliance_name, cutoff))
+        oldest = cursor.fetchall()
+      if not oldest:
+        break
+      compacted += compact_day(appliance_name, oldest[0][0].date())
+    with get_cursor(commit=True) as cursor:
+      set_compacted_until(cursor, appliance_name, cutoff)
+    read_cache.invalidate(("compacted_until", appliance_name))
+
+  with get_cursor(commit=True) as cursor:
+    cursor.execute("DELETE FROM ShutEyeDeviceEnergyDataMinute WHERE bucket_start < %s;", (datetime.combine(today - timedelta(days=minute_retention_days), time()),))
+  return compacted
+
+class RetentionWorker:     # Runs run_retention() every retention_interval seconds on a background thread, or sooner when woken
+  def __init__(self, interval: float = retention_interval):
+    self.interval = interval
+    self._stopped = threading.Event()
+    self._wake = threading.Event()
+    self._thread = None
+
+  def start(self) -> None:
+    if self._thread is None and self.interval > 0:
+      self._stopped.clear()
+      self._thread = threading.Thread(target=self._run, name="retention", daemon=True)
+      self._thread.start()
+
+  def stop(self) -> None:
+    self._stopped.set()
+    self._wake.set()
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+
+  def wake(self) -> None:    # Starts the next run now, e.g. when samples arrive for a day that was already compacted
+    self._wake.set()
+
+  def _run(self) -> None:
+    while not self._stopped.is_set():
+      self._wake.clear()
+      try:
+        compacted = run_retention()
+        if compacted:
+          print("Retention compacted {0} raw samples".format(compacted))
+      except Exception as err:
+        print("Retention run failed: {0}".format(err))
+      self._wake.wait(self.interval)
+
+retention_worker = RetentionWorker()
+
+if __name__ == "__main__":      # Run directly (e.g. from cron with RETENTION_INTERVAL=0 for the server) to compact once
+  print("Compacted {0} raw samples".format(run_retention()))
@@ -1,35 +1,57 @@
-from fastapi import FastAPI, Request, Form
+from fastapi import FastAPI, Request, Form, Body, Query, WebSocket, WebSocketDisconnect
 from fastapi.responses import Response
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 import uvicorn
-import os
+import json
+import asyncio
+from itertools import islice, chain
+from typing import List
 import mysql.connector as mysql
-from dotenv import load_dotenv
+from db import get_cursor
+from ingest import PERIODIC_COLUMNS, parse_local_time, parse_periodic_sample, parse_historical_sample, periodic_buffer, historical_buffer, max_bulk
+import mqtt_ingest
+import catalog
+import retention
+import metrics
+from live import hub, row_to_dict
+from aggregate import energy_summary
+from datetime import datetime, timedelta
 
-load_dotenv()                 # Retreives the credentials needed to conenct to the data server
-db_host = "localhost"
-db_user = "root"
-db_pass = os.environ['MYSQL_ROOT_PASSWORD']
-db_name = "ShutEyeDataServer"                           
+MAX_SUMMARY_BUCKETS = 10000     # Upper bound on buckets per energy summary request
+STREAM_CHUNK_ROWS = 1000        # Rows read from the database cursor at a time
 
 app = FastAPI()
+app.add_middleware(metrics.MetricsMiddleware)     # Per route request counts and latency for /metrics
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
+@app.on_event("startup")      # Starts the background threads that batch inserts, then the MQTT subscriber that feeds them, and the retention job
+def start_ingest() -> None:
+  periodic_buffer.start()
+  historical_buffer.start()
+  mqtt_ingest.start()
+  retention.retention_worker.start()
+
+@app.on_event("shutdown")     # Stops taking new MQTT messages and writes out any buffered measurements before the server exits
+def stop_ingest() -> None:
+  retention.retention_worker.stop()
+  mqtt_ingest.stop()
+  periodic_buffer.stop()
+  historical_buffer.stop()
+
 @app.get("/", response_class=HTMLResponse)       # Returns the index HTML page for the default URL path
 def get_html() -> HTMLResponse:                 
   with open('index.html') as html:             
     return HTMLResponse(content=html.read())
 
+@app.get("/metrics", response_class=PlainTextResponse)    # Prometheus text format metrics for the requests, database calls and ingest of this server process
+def get_metrics() -> PlainTextResponse:
+    return PlainTextResponse(content=metrics.registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 @app.get("/shuteye_historical_data/{appliance_name}", response_class=JSONResponse)   # REST API route to fetch historical data
 def fetch_historical_data(appliance_name: str) -> JSONResponse:
     try:
-        db = mysql.connect(host=db_host, database=db_name, user=db_user, passwd=db_pass)
-        cursor = db.cursor()
-        query = "SELECT * FROM ShutEyeDeviceEnergyDataHistorical WHERE appliance_name = %s ORDER BY local_time DESC LIMIT 1;"
-        value = (appliance_name,)
-        cursor.execute(query, value)
-        records = cursor.fetchall()
+        records = catalog.fetch_latest_historical(appliance_name)   # Cached until new historical data for the appliance is committed
         response = {}
         for index, row in enumerate(records):  # Iterate through the database data to construct the dict to return as JSON
             response[index] = {
@@ -40,7 +62,6 @@ def fetch_historical_data(appliance_name: str) -> JSONResponse:
                 "today_energy": row[4],
                 "month_energy": row[5]
             }
-        db.close()
         return JSONResponse(content=response)
     except mysql.Error as err:
         return JSONResponse(status_code=500, content={"error": f"Database error: {err}"})
@@ -48,105 +69,247 @@ def fetch_historical_data(appliance_name: str) -> JSONResponse:
         return JSONResponse(status_code=500, content={"error": f"An error occurred: {e}"})
     
 
-@app.get("/shuteye_periodic_measurement_data/{appliance_name}", response_class=JSONResponse) # REST API route to fetch periodic measurement data
-def fetch_periodic_measurement_data(appliance_name: str) -> JSONResponse:
+def periodic_row_to_dict(row: tuple) -> dict:    # Converts a ShutEyeDeviceEnergyDataPeriodicMeasurement row into the JSON object returned by the API
+    return row_to_dict(PERIODIC_COLUMNS, row)
+
+def iter_periodic_rows(appliance_name: str, start: datetime = None, end: datetime = None, after: datetime = None, limit: int = None):
+    # Yields periodic measurement rows in time order, from the archive for times the retention job has compacted and from the
+    # database after that. The database is read STREAM_CHUNK_ROWS at a time with a keyset query per chunk, so the full result set
+    # is never held in memory and no pooled connection is held while the caller (e.g. a slow download) consumes the rows
+    compacted_until = catalog.fetch_compacted_until(appliance_name)
+    if compacted_until is not None and (start is None or start < compacted_until) and (after is None or after < compacted_until):
+        archive_end = min(end, compacted_until) if end is not None else compacted_until
+        for row in retention.read_archive(appliance_name, start, archive_end, after):
+            if limit is not None:
+                if limit == 0:
+                    return
+                limit -= 1
+            yield row
+        start = compacted_until
+
+    while limit is None or limit > 0:
+        chunk_size = STREAM_CHUNK_ROWS if limit is None else min(limit, STREAM_CHUNK_ROWS)
+        conditions = ["appliance_name = %s"]
+        values = [appliance_name]
+        for bound, condition in ((start, "local_time >= %s"), (end, "local_time < %s"), (after, "local_time > %s")):   # Keyset pagination on the (appliance_name, local_time) primary key
+            if bound is not None:
+                conditions.append(condition)
+                values.append(bound)
+        query = "SELECT * FROM ShutEyeDeviceEnergyDataPeriodicMeasurement WHERE " + " AND ".join(conditions) + " ORDER BY local_time ASC LIMIT %s"
+        with get_cursor() as cursor:
+            cursor.execute(query, tuple(values) + (chunk_size,))
+            rows = cursor.fetchall()
+        yield from rows
+        if len(rows) < chunk_size:
+            return
+        after = rows[-1][1]
+        if limit is not None:
+            limit -= len(rows)
+
+def stream_periodic_rows(rows):    # Yields rows as NDJSON lines, STREAM_CHUNK_ROWS lines at a time
+    while True:
+        chunk = list(islice(rows, STREAM_CHUNK_ROWS))
+        if not chunk:
+            break
+        yield "".join(json.dumps(periodic_row_to_dict(row)) + "\n" for row in chunk)
+
+@app.get("/shuteye_periodic_measurement_data/{appliance_name}", response_class=JSONResponse) # REST API route to fetch periodic measurement data, optionally limited to [start, end) and paged with limit and the after cursor
+def fetch_periodic_measurement_data(appliance_name: str, start: str = None, end: str = None, after: str = None, limit: int = None,
+                                    response_format: str = Query("json", alias="format")) -> Response:
+    # format=json (default) returns the original object keyed by row index, format=columnar returns parallel arrays per column,
+    # format=ndjson streams one JSON object per line. When limit is given and more rows remain, the next page is requested with
+    # after=<next_cursor>, which is returned in the X-Next-Cursor header (and in the body for the columnar format)
+    if response_format not in ("json", "columnar", "ndjson"):
+        return JSONResponse(status_code=422, content={"error": "format must be one of json, columnar or ndjson"})
+    if limit is not None and limit <= 0:
+        return JSONResponse(status_code=422, content={"error": "limit must be positive"})
+    try:
+        start, end, after = [parse_local_time(bound) if bound else None for bound in (start, end, after)]
+    except ValueError as err:
+        return JSONResponse(status_code=422, content={"error": f"Invalid date: {err}"})
+
+    if response_format == "ndjson":    # Each line holds its own local_time, so the last line received is the cursor for the next page
+        rows = iter_periodic_rows(appliance_name, start, end, after, limit)
+        try:
+            first_chunk = list(islice(rows, STREAM_CHUNK_ROWS))   # Read before the 200 is sent, so a database that is down is still reported as an error
+        except mysql.Error as err:
+            return JSONResponse(status_code=500, content={"error": f"Database error: {err}"})
+        except Exception as e:
+            return JSONResponse(status_code=500, content={"error": f"An error occurred: {e}"})
+        return StreamingResponse(stream_periodic_rows(chain(first_chunk, rows)), media_type="application/x-ndjson")
+
     try:
-        db = mysql.connect(host=db_host, database=db_name, user=db_user, passwd=db_pass)
-        cursor = db.cursor()
-        query = "SELECT * FROM ShutEyeDeviceEnergyDataPeriodicMeasurement WHERE appliance_name = %s ORDER BY local_time ASC;"
-        value = (appliance_name,)
-        cursor.execute(query, value)
-        records = cursor.fetchall()
+        records = list(iter_periodic_rows(appliance_name, start, end, after, limit))
+        next_cursor = records[-1][1].strftime("%Y-%m-%d %H:%M:%S") if limit is not None and len(records) == limit else None
+        headers = {"X-Next-Cursor": next_cursor} if next_cursor else None
+
+        if response_format == "columnar":
+            response = {
+                "appliance_name": appliance_name,
+                "local_time": [row[1].strftime("%Y-%m-%d %H:%M:%S") for row in records],
+                "current_power": [row[2] for row in records],
+                "distance_ultrasonic": [row[3] for row in records],
+                "distance_bluetooth": [row[4] for row in records],
+                "distance_ultrawideband": [row[5] for row in records],
+                "user_presence_detected": [row[6] for row in records],
+                "next_cursor": next_cursor,
+            }
+            return JSONResponse(content=response, headers=headers)
+
         response = {}
         for index, row in enumerate(records):  # Iterate through the database data to construct the dict to return as JSON
-            response[index] = {
-                "appliance_name": row[0],
-                "local_time": row[1].strftime("%Y-%m-%d %H:%M:%S"),
-                "current_power": row[2],
-                "distance_ultrasonic": row[3],
-                "distance_bluetooth": row[4],
-                "distance_ultrawideband": row[5],
-                "user_presence_detected": row[6],
-            }
-        db.close()
-        return JSONResponse(content=response)
+            response[index] = periodic_row_to_dict(row)
+        return JSONResponse(content=response, headers=headers)
     except mysql.Error as err:
         return JSONResponse(status_code=500, content={"error": f"Database error: {err}"})
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": f"An error occurred: {e}"})
     
-@app.post("/shuteye_historical_data")      # REST API route to insert historical data into the database
+@app.get("/shuteye_energy_summary/{appliance_name}", response_class=JSONResponse) # REST API route to fetch energy and user presence totals per time bucket, for a single date or a start/end range
+def fetch_energy_summary(appliance_name: str, date: str = None, start: str = None, end: str = None, bucket_minutes: int = 60) -> JSONResponse:
+    try:
+        if date:
+            range_start = datetime.strptime(date, "%Y-%m-%d")
+            range_end = range_start + timedelta(days=1)
+        elif start and end:
+            range_start, range_end = parse_local_time(start), parse_local_time(end)
+        else:
+            return JSONResponse(status_code=422, content={"error": "Either date or both start and end are required"})
+        if bucket_minutes <= 0 or range_end <= range_start:
+            return JSONResponse(status_code=422, content={"error": "bucket_minutes must be positive and end must be after start"})
+        if (range_end - range_start) / timedelta(minutes=bucket_minutes) > MAX_SUMMARY_BUCKETS:
+            return JSONResponse(status_code=422, content={"error": f"At most {MAX_SUMMARY_BUCKETS} buckets can be requested"})
+    except ValueError as err:
+        return JSONResponse(status_code=422, content={"error": f"Invalid date: {err}"})
+
+    try:
+        compacted_until = catalog.fetch_compacted_until(appliance_name)
+        rollups = None
+        records = []
+        raw_start = range_start
+        if compacted_until is not None and range_start < compacted_until:   # Older parts of the range come from the rollups written by the retention job
+            rollups = retention.fetch_rollups(appliance_name, range_start, min(range_end, compacted_until), bucket_minutes * 60)
+            if rollups is None:    # The buckets do not line up with a rollup table (or start before the minute rollups kept), so sum the archived samples instead
+                records = [(row[1], row[2], row[6]) for row in retention.read_archive(appliance_name, range_start, min(range_end, compacted_until))]
+            raw_start = max(range_start, compacted_until)
+
+        if raw_start < range_end:
+            query = """
+                SELECT local_time, current_power, user_presence_detected
+                FROM ShutEyeDeviceEnergyDataPeriodicMeasurement
+                WHERE appliance_name = %s AND local_time >= %s AND local_time < %s
+                ORDER BY local_time ASC;
+            """
+            value = (appliance_name, raw_start, range_end)
+            with get_cursor() as cursor:
+                cursor.execute(query, value)
+                records += cursor.fetchall()
+        times, power, presence = zip(*records) if records else ((), (), ())
+        response = energy_summary(times, power, presence, range_start, range_end, bucket_minutes * 60, rollups)
+        return JSONResponse(content=response)
+    except mysql.Error as err:
+        return JSONResponse(status_code=500, content={"error": f"Database error: {err}"})
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"error": f"An error occurred: {e}"})
+
+@app.post("/shuteye_historical_data")      # REST API route to insert historical data into the database (written in batches by the write-behind buffer)
 def insert_historical_data(appliance_historical_data: dict):
-  db = mysql.connect(host=db_host, database=db_name, user=db_user, passwd=db_pass)
-  cursor = db.cursor()
-  query = "insert into ShutEyeDeviceEnergyDataHistorical(appliance_name, local_time, today_runtime, month_runtime, today_energy, month_energy) values (%s, %s, %s, %s, %s, %s)"
-  value = (appliance_historical_data['appliance_name'], appliance_historical_data['local_time'], appliance_historical_data['today_runtime'], appliance_historical_data['month_runtime'], appliance_historical_data['today_energy'], appliance_historical_data['month_energy'])
   try:
-    cursor.execute(query, value)
-  except mysql.Error as err:
-      return JSONResponse(status_code=500, content={"error": f"Database error: {err}"})
-  except Exception as e:
-      return JSONResponse(status_code=500, content={"error": f"An error occurred: {e}"})
-  db.commit()
-  db.close()
-
-@app.post("/shuteye_periodic_measurement_data")    # REST API route to insert periodic measurement data into the database
+    row = parse_historical_sample(appliance_historical_data)
+  except ValueError as err:
+    return JSONResponse(status_code=422, content={"error": f"{err}"})
+  if not historical_buffer.add([row]):
+    metrics.ingest_rejected.inc(historical_buffer.kind)
+    return JSONResponse(status_code=503, content={"error": "Ingest buffer is full, retry later"})
+
+@app.post("/shuteye_periodic_measurement_data")    # REST API route to insert periodic measurement data into the database (written in batches by the write-behind buffer)
 def insert_periodic_measurement_data(appliance_periodic_data: dict):
-  db = mysql.connect(host=db_host, database=db_name, user=db_user, passwd=db_pass)
-  cursor = db.cursor()
-  query = "insert into ShutEyeDeviceEnergyDataPeriodicMeasurement(appliance_name, local_time, current_power, distance_ultrasonic, distance_bluetooth, distance_ultrawideband, user_presence_detected) values (%s, %s, %s, %s, %s, %s, %s)"
-  value = (appliance_periodic_data['appliance_name'], appliance_periodic_data['local_time'], appliance_periodic_data['current_power'], appliance_periodic_data['distance_ultrasonic'], appliance_periodic_data['distance_bluetooth'], appliance_periodic_data['distance_ultrawideband'], appliance_periodic_data['user_presence_detected'])
   try:
-    cursor.execute(query, value)
-  except mysql.Error as err:
-      return JSONResponse(status_code=500, content={"error": f"Database error: {err}"})
-  except Exception as e:
-      return JSONResponse(status_code=500, content={"error": f"An error occurred: {e}"})
-  db.commit()
-  db.close()
-
-@app.get("/appliance_names", response_class=JSONResponse)    # Retrieves list of unique appliance names from the database for the web and mobile app dropdowns
+    row = parse_periodic_sample(appliance_periodic_data)
+  except ValueError as err:
+    return JSONResponse(status_code=422, content={"error": f"{err}"})
+  if not periodic_buffer.add([row]):
+    metrics.ingest_rejected.inc(periodic_buffer.kind)
+    return JSONResponse(status_code=503, content={"error": "Ingest buffer is full, retry later"})
+
+@app.post("/shuteye_periodic_measurement_data/bulk", response_class=JSONResponse)    # REST API route to insert an array of periodic measurements in one request
+def insert_periodic_measurement_data_bulk(appliance_periodic_data: List[dict] = Body(...)) -> JSONResponse:
+  limit = min(max_bulk, periodic_buffer.max_pending)
+  if len(appliance_periodic_data) > limit:     # Could never fit in the buffer, so retrying after a 503 would not help
+    return JSONResponse(status_code=413, content={"error": f"At most {limit} samples can be sent in one request"})
+  rows = []
+  for index, sample in enumerate(appliance_periodic_data):   # Validate every sample before queueing any of them so a bad request has no partial effect
+    try:
+      rows.append(parse_periodic_sample(sample))
+    except ValueError as err:
+      return JSONResponse(status_code=422, content={"error": f"Sample {index}: {err}"})
+  if not periodic_buffer.add(rows):
+    metrics.ingest_rejected.inc(periodic_buffer.kind, amount=len(rows))
+    return JSONResponse(status_code=503, content={"error": "Ingest buffer is full, retry later"})
+  return JSONResponse(status_code=202, content={"queued": len(rows)})
+
+@app.get("/appliance_names", response_class=JSONResponse)    # Retrieves list of unique appliance names from the catalog for the web and mobile app dropdowns
 def fetch_appliance_names() -> JSONResponse:
     try:
-        db = mysql.connect(host=db_host, database=db_name, user=db_user, passwd=db_pass)
-        cursor = db.cursor()
-        query = "SELECT DISTINCT appliance_name FROM ShutEyeDeviceEnergyDataPeriodicMeasurement;"
-        cursor.execute(query)
-        appliance_names = cursor.fetchall()
-
-        appliance_names = [name[0] for name in appliance_names]
-        db.close()
-        
+        appliance_names = catalog.fetch_appliance_names()
         return JSONResponse(content={"appliance_names": appliance_names})
     except mysql.Error as err:
         return JSONResponse(status_code=500, content={"error": f"Database error: {err}"})
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": f"An error occurred: {e}"})
     
-@app.get("/available_dates/{appliance_name}", response_class=JSONResponse) # Retrieves list of dates with data for a given appliance name from the database for the web and mobile app dropdowns
+@app.get("/available_dates/{appliance_name}", response_class=JSONResponse) # Retrieves list of dates with data for a given appliance name from the catalog for the web and mobile app dropdowns
 def fetch_available_dates(appliance_name: str) -> JSONResponse:
     try:
-        db = mysql.connect(host=db_host, database=db_name, user=db_user, passwd=db_pass)
-        cursor = db.cursor()
-        query = """
-            SELECT DISTINCT DATE(local_time) 
-            FROM ShutEyeDeviceEnergyDataPeriodicMeasurement 
-            WHERE appliance_name = %s
-            ORDER BY local_time DESC;
-        """
-        value = (appliance_name,)
-        cursor.execute(query, value)
-        dates = cursor.fetchall()
-
-        # Extract date strings from the result
-        dates = [date[0].strftime("%Y-%m-%d") for date in dates]
-        db.close()
-        
+        dates = catalog.fetch_available_dates(appliance_name)
         return JSONResponse(content={"dates": dates})
     except mysql.Error as err:
         return JSONResponse(status_code=500, content={"error": f"Database error: {err}"})
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": f"An error occurred: {e}"})
 
+async def live_messages(subscriber):    # Yields the subscriber's messages, a "dropped" notice when the client fell behind, and None when a keepalive is due
+    while True:
+        message = await subscriber.next()
+        dropped = subscriber.take_dropped()
+        if dropped:
+            yield {"type": "dropped", "data": {"count": dropped}}
+        yield message
+
+@app.get("/live/{appliance_name}")    # Server-Sent Events stream of periodic and historical records for an appliance as they are stored
+async def live_events(appliance_name: str, request: Request) -> Response:
+    subscriber = hub.subscribe(appliance_name, asyncio.get_running_loop())
+    if subscriber is None:
+        return JSONResponse(status_code=503, content={"error": "Too many live clients connected"})
+
+    async def events():
+        try:
+            async for message in live_messages(subscriber):
+                if await request.is_disconnected():
+                    break
+                if message is None:
+                    yield ": keepalive\n\n"
+                else:
+                    yield f"event: {message['type']}\ndata: {json.dumps(message['data'])}\n\n"
+        finally:
+            hub.unsubscribe(subscriber)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.websocket("/live/{appliance_name}/ws")    # WebSocket stream of the same messages as /live/{appliance_name}, one JSON object per message
+async def live_websocket(websocket: WebSocket, appliance_name: str) -> None:
+    subscriber = hub.subscribe(appliance_name, asyncio.get_running_loop())
+    if subscriber is None:
+        await websocket.close(code=1013)     # Try again later
+        return
+    await websocket.accept()
+    try:
+        async for message in live_messages(subscriber):
+            await websocket.send_json(message if message is not None else {"type": "keepalive"})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        hub.unsubscribe(subscriber)
+
 if __name__ == "__main__":      # Starts the app
     uvicorn.run(app, host="0.0.0.0", port=6543)
\ No newline at end of file
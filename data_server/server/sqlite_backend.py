@@ -0,0 +1,124 @@
+import os
+import re
+import queue
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime, date
+from mysql.connector import errors
+
+# SQLite stand-in for the MariaDB data server, selected with DB_BACKEND=sqlite, so the server can run (e.g. for the
+# benchmark suite) on a machine without MariaDB. The schema comes from init_db.sql and the MySQL dialect used by the
+# routes is translated per query, so the rest of the server is unaware of which backend it is talking to
+
+schema_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "init_db.sql")
+
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(" "))
+sqlite3.register_adapter(date, lambda value: value.isoformat())
+sqlite3.register_converter("DATETIME", lambda value: datetime.fromisoformat(value.decode()))
+sqlite3.register_converter("DATE", lambda value: date.fromisoformat(value.decode()))
+
+def translate(query: str) -> str:    # Rewrites the MySQL specific syntax used by the server into its SQLite equivalent
+  query = query.replace("%s", "?")
+  query = re.sub(r"\s+FOR UPDATE", "", query, flags=re.IGNORECASE)
+  query = re.sub(r"\bLEAST\(", "MIN(", query, flags=re.IGNORECASE)
+  query = re.sub(r"\bGREATEST\(", "MAX(", query, flags=re.IGNORECASE)
+  match = re.search(r"\s+on duplicate key update\s+", query, flags=re.IGNORECASE)
+  if match:
+    updates = query[match.end():]
+    if re.fullmatch(r"appliance_name = appliance_name;?\s*", updates, flags=re.IGNORECASE):
+      return query[:match.start()] + " on conflict do nothing"
+    updates = re.sub(r"\bVALUES\((\w+)\)", r"excluded.\1", updates, flags=re.IGNORECASE)
+    query = query[:match.start()] + " on conflict do update set " + updates
+  return query
+
+def create_table_statements(statement: str) -> list:    # A MySQL CREATE TABLE with its inline secondary keys turned into CREATE INDEX statements
+  table = re.match(r"\s*CREATE TABLE (?:IF NOT EXISTS )?(\w+)", statement, flags=re.IGNORECASE).group(1)
+  keys = re.findall(r",\s*KEY \((\w+)\)", statement)
+  return ([re.sub(r",\s*KEY \(\w+\)", "", statement)]
+          + [f"CREATE INDEX IF NOT EXISTS {table}_{column} ON {table}({column})" for column in keys])
+
+def schema_statements() -> list:    # The CREATE TABLE statements of init_db.sql, in SQLite syntax
+  with open(schema_path) as schema:
+    statements = [statement.strip() for statement in schema.read().split(";") if statement.strip()]
+  result = []
+  for statement in statements:
+    if statement.upper().startswith("CREATE TABLE"):     # CREATE DATABASE, USE and DROP TABLE only apply to MariaDB or to re-initialization
+      result += create_table_statements(statement)
+  return result
+
+@contextmanager
+def mysql_errors():     # Raises sqlite3 errors as their mysql-connector counterparts, so callers tell errors caused by the rows written from the rest the same way for both backends
+  try:
+    yield
+  except sqlite3.OperationalError as err:
+    raise errors.OperationalError(msg=str(err)) from err
+  except sqlite3.IntegrityError as err:
+    raise errors.IntegrityError(msg=str(err)) from err
+  except sqlite3.DataError as err:
+    raise errors.DataError(msg=str(err)) from err
+  except sqlite3.Error as err:
+    raise errors.DatabaseError(msg=str(err)) from err
+
+class Cursor:     # Wraps an sqlite3 cursor, translating each query on the way in
+  def __init__(self, cursor: sqlite3.Cursor):
+    self._cursor = cursor
+
+  def execute(self, query: str, params=()) -> None:
+    with mysql_errors():
+      if query.lstrip().upper().startswith("CREATE TABLE"):
+        for statement in create_table_statements(query):
+          self._cursor.execute(statement)
+      else:
+        self._cursor.execute(translate(query), tuple(params or ()))
+
+  def fetchall(self) -> list:
+    return self._cursor.fetchall()
+
+  def fetchmany(self, size: int) -> list:
+    return self._cursor.fetchmany(size)
+
+  def close(self) -> None:
+    self._cursor.close()
+
+class Connection:     # Pooled connection with the subset of the mysql-connector connection API that db.py uses
+  def __init__(self, pool, connection: sqlite3.Connection):
+    self._pool = pool
+    self._connection = connection
+
+  def ping(self, **kwargs) -> None:
+    pass
+
+  def cursor(self) -> Cursor:
+    return Cursor(self._connection.cursor())
+
+  def commit(self) -> None:
+    with mysql_errors():
+      self._connection.commit()
+
+  def rollback(self) -> None:
+    self._connection.rollback()
+
+  def close(self) -> None:     # Returns the connection to the pool, like a pooled mysql-connector connection
+    self._connection.rollback()
+    self._pool.release(self._connection)
+
+class SQLitePool:
+  def __init__(self, path: str, pool_size: int):
+    self._connections = queue.Queue()
+    for index in range(pool_size):
+      connection = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False, timeout=30)
+      connection.execute("PRAGMA journal_mode=WAL")       # Readers do not block the writer
+      connection.execute("PRAGMA synchronous=NORMAL")
+      if index == 0:
+        existing = connection.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table'").fetchone()[0]
+        if not existing:     # A new database file gets the schema, an existing one keeps its data
+          for statement in schema_statements():
+            connection.execute(statement)
+          connection.commit()
+      self._connections.put(connection)
+
+  def get_connection(self) -> Connection:    # db.py bounds the callers with its own semaphore, so a connection is always free here
+    return Connection(self, self._connections.get_nowait())
+
+  def release(self, connection: sqlite3.Connection) -> None:
+    self._connections.put(connection)
@@ -61,73 +61,15 @@ document.addEventListener("DOMContentLoaded", function () {
     }
 
     try {
-      const response = await fetch(`/shuteye_periodic_measurement_data/${applianceName}`);
+      const response = await fetch(`/shuteye_energy_summary/${applianceName}?date=${selectedDate}&bucket_minutes=60`);  // The server integrates energy and presence per hour for the selected date
       const data = await response.json();
 
-      const filteredData = Object.values(data).filter(entry => entry.local_time.includes(selectedDate));  // Filters data to only include entries for the selected date
-
-      const hours = Array.from({ length: 24 }, (_, i) => `${String(i).padStart(2, "0")}:00`); // Creates an array of hours from 00:00 to 23:00
-
-      console.log("Hours Array:", hours);
-      console.log("Filtered Data:", filteredData);
-      filteredData.forEach(entry => console.log(entry.local_time));
-
-      const totalPowerData = [];
-      const userPresenceEnergyData = [];
-      const noUserPresenceEnergyData = [];
-      const userPresencePercentageData = [];
-
-      hours.forEach(hour => {
-        const hourStart = new Date(`${selectedDate} ${hour}`);
-        const hourEnd = new Date(hourStart);
-        hourEnd.setHours(hourStart.getHours() + 1);  // End time is 1 hour after start
-
-        // Filter data to only include entries within the current hour range
-        const hourData = filteredData.filter(entry => {
-          const entryTime = new Date(entry.local_time);
-          return entryTime >= hourStart && entryTime < hourEnd;
-        });
-
-        let totalMilliwattSeconds = 0;
-        let userPresenceMilliwattSeconds = 0;
-        let noUserPresenceMilliwattSeconds = 0;
-        let totalPresenceTime = 0;
-        let totalTimeInHour = 0;
-
-        if (hourData.length > 0) { 
-          for (let i = 0; i < hourData.length; i++) {  // Start at 0, not 1
-            const currentMeasurement = hourData[i];
-            const previousMeasurement = hourData[i - 1];  // Use previousMeasurement only if i > 0
-
-            if (previousMeasurement) {
-              const previousTime = new Date(previousMeasurement.local_time);
-              const currentTime = new Date(currentMeasurement.local_time);
-              const timeDifferenceInSeconds = (currentTime - previousTime) / 1000;  // Gets the total time difference in seconds, millieconds need to be converted to seconds
-
-              const milliWattSeconds = timeDifferenceInSeconds * previousMeasurement.current_power;
-
-              totalMilliwattSeconds += milliWattSeconds;
-              totalTimeInHour += timeDifferenceInSeconds;
-
-              if (previousMeasurement.user_presence_detected) {
-                userPresenceMilliwattSeconds += milliWattSeconds;
-                totalPresenceTime += timeDifferenceInSeconds;
-              } else {
-                noUserPresenceMilliwattSeconds += milliWattSeconds;
-              }
-            }
-          }
-        }
-
-        const totalWattHours = totalMilliwattSeconds / (3600 * 1000);  // Convert milliWatt-seconds to Watt-hours
-        const userPresenceWattHours = userPresenceMilliwattSeconds / (3600 * 1000);
-        const noUserPresenceWattHours = noUserPresenceMilliwattSeconds / (3600 * 1000);
+      const hours = data.bucket_start.map(bucketStart => bucketStart.slice(11, 16)); // Labels each bucket by its start time, from 00:00 to 23:00
 
-        totalPowerData.push(totalWattHours);
-        userPresenceEnergyData.push(userPresenceWattHours);
-        noUserPresenceEnergyData.push(noUserPresenceWattHours);
-        userPresencePercentageData.push(totalTimeInHour > 0 ? (totalPresenceTime / totalTimeInHour) * 100 : 0);
-      });
+      const totalPowerData = data.total_energy_wh;
+      const userPresenceEnergyData = data.presence_energy_wh;
+      const noUserPresenceEnergyData = data.no_presence_energy_wh;
+      const userPresencePercentageData = data.presence_percentage;
 
       updateTotalEnergyChart(hours, totalPowerData);     // Updates the charts with the data
       updateEnergyPresenceChart(hours, userPresenceEnergyData, noUserPresenceEnergyData);
@@ -0,0 +1,45 @@
+import os
+import sys
+import shutil
+import tempfile
+import pytest
+
+# The server modules import each other by bare name (they are run from data_server/server), and use the SQLite stand-in
+# so the tests do not need MariaDB
+SERVER_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server")
+sys.path.insert(0, SERVER_DIR)
+os.environ.setdefault("DB_BACKEND", "sqlite")
+
+_scratch = tempfile.mkdtemp(prefix="shuteye-tests-")     # Holds the SQLite database and the archive of the tests that store data
+os.environ.setdefault("DB_SQLITE_PATH", os.path.join(_scratch, "ShutEyeDataServer.sqlite3"))
+os.environ.setdefault("ARCHIVE_DIR", os.path.join(_scratch, "archive"))
+
+def pytest_sessionfinish(session, exitstatus):
+  shutil.rmtree(_scratch, ignore_errors=True)
+
+@pytest.fixture
+def database():    # Empties every table, the archive and the read cache before and after a test that stores data
+  import db
+  import retention
+  from cache import read_cache
+  if db.db_backend != "sqlite":
+    pytest.skip("deletes every row, so it only runs against the SQLite stand-in")
+
+  def empty():
+    with db.get_cursor(commit=True) as cursor:
+      cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table';")
+      for (table,) in cursor.fetchall():
+        cursor.execute(f"DELETE FROM {table};")
+    shutil.rmtree(retention.archive_dir, ignore_errors=True)
+    read_cache.clear()
+
+  empty()
+  yield
+  empty()
+
+@pytest.fixture
+def api(database, monkeypatch):    # A TestClient for server.py without its startup handlers (no write-behind, MQTT or retention threads)
+  from fastapi.testclient import TestClient
+  monkeypatch.chdir(SERVER_DIR)     # server.py serves its static files and index.html relative to the working directory
+  import server
+  return TestClient(server.app)
@@ -0,0 +1,36 @@
+import random
+from datetime import datetime, timedelta
+import numpy as np
+import pytest
+from aggregate import energy_summary, rollup
+
+DAY = datetime(2024, 1, 2)
+
+@pytest.fixture
+def samples():    # A day of irregularly spaced samples, with gaps that cross minute and hour boundaries
+  rng = random.Random(1)
+  times, power, presence = [], [], []
+  time = DAY
+  while time < DAY + timedelta(days=1):
+    times.append(time)
+    power.append(rng.randint(0, 60000))
+    presence.append(rng.random() < 0.5)
+    time += timedelta(seconds=rng.choice([3, 5, 7, 61, 400]))
+  return times, power, presence
+
+@pytest.mark.parametrize("rollup_seconds, bucket_minutes", [(60, 7), (60, 15), (60, 90), (3600, 60), (3600, 240)])
+def test_summary_from_rollups_matches_raw(samples, rollup_seconds, bucket_minutes):
+  times, power, presence = samples
+  raw = energy_summary(times, power, presence, DAY, DAY + timedelta(days=1), bucket_minutes * 60)
+  rows = rollup(times, power, presence, np.zeros((len(times), 3)), rollup_seconds)
+  rollups = {column: rows[column].tolist() for column in ("energy", "presence_energy", "covered_seconds", "presence_seconds")}
+  rollups["bucket_start"] = rows["bucket_start"].astype(datetime).tolist()
+  compacted = energy_summary((), (), (), DAY, DAY + timedelta(days=1), bucket_minutes * 60, rollups)
+  assert compacted["bucket_start"] == raw["bucket_start"]
+  for column in ("total_energy_wh", "presence_energy_wh", "no_presence_energy_wh", "presence_percentage"):
+    assert np.allclose(compacted[column], raw[column])
+
+def test_pairs_across_an_hour_boundary_are_not_counted():
+  times = [DAY + timedelta(minutes=59), DAY + timedelta(minutes=61), DAY + timedelta(minutes=62)]
+  summary = energy_summary(times, [3600000, 3600000, 3600000], [True, True, True], DAY, DAY + timedelta(hours=2), 3600)
+  assert summary["total_energy_wh"] == [0.0, 60.0]
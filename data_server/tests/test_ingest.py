@@ -0,0 +1,168 @@
+import time
+from datetime import datetime, timedelta
+import pytest
+from mysql.connector import errors
+import metrics
+from ingest import WriteBehindBuffer, periodic_buffer
+
+def counted(counter, kind: str = "test") -> float:
+  return counter._values.get((kind,), 0)
+
+def wait_for(condition, timeout: float = 2) -> bool:
+  deadline = time.monotonic() + timeout
+  while not condition():
+    if time.monotonic() > deadline:
+      return False
+    time.sleep(0.01)
+  return True
+
+class Table:     # Stands in for insert_periodic_rows(), recording each batch written and failing as told
+  def __init__(self):
+    self.batches = []
+    self.failures = []     # Exceptions raised by the next calls, one per call
+    self.bad_rows = set()  # Rows that make any batch holding them fail with a DataError
+
+  def __call__(self, rows: list) -> None:
+    if self.failures:
+      raise self.failures.pop(0)
+    if self.bad_rows.intersection(rows):
+      raise errors.DataError(msg="Out of range value")
+    self.batches.append(list(rows))
+
+  @property
+  def rows(self) -> list:
+    return [row for batch in self.batches for row in batch]
+
+@pytest.fixture
+def table():
+  return Table()
+
+def test_flushes_when_batch_size_is_reached(table):
+  buffer = WriteBehindBuffer(table, "test", batch_size=3, flush_interval=60)
+  buffer.start()
+  try:
+    buffer.add([1, 2])
+    buffer.add([3])
+    assert wait_for(lambda: table.rows == [1, 2, 3])
+  finally:
+    buffer.stop()
+  assert table.batches == [[1, 2, 3]]
+
+def test_flushes_after_flush_interval(table):
+  buffer = WriteBehindBuffer(table, "test", batch_size=100, flush_interval=0.05)
+  buffer.start()
+  try:
+    buffer.add([1])
+    assert wait_for(lambda: table.rows == [1])
+  finally:
+    buffer.stop()
+
+def test_stop_writes_out_buffered_rows(table):
+  buffer = WriteBehindBuffer(table, "test", batch_size=100, flush_interval=60)
+  buffer.start()
+  buffer.add([1, 2])
+  buffer.stop()
+  assert table.rows == [1, 2]
+
+@pytest.mark.parametrize("error", [
+  errors.OperationalError(msg="Lost connection to MySQL server during query"),
+  errors.DatabaseError(msg="Lock wait timeout exceeded", errno=1205),
+  errors.InternalError(msg="Deadlock found when trying to get lock", errno=1213),
+  errors.ProgrammingError(msg="Table doesn't exist", errno=1146),
+])
+def test_failed_batches_are_retried_in_order(table, error):
+  buffer = WriteBehindBuffer(table, "test")
+  table.failures.append(error)
+  failed = counted(metrics.ingest_failed_rows)
+  buffer.add([1, 2, 3])
+  buffer.flush()
+  assert table.rows == [] and buffer.pending() == 3
+  assert counted(metrics.ingest_failed_rows) - failed == 3
+  buffer.add([4])
+  buffer.flush()
+  assert table.batches == [[1, 2, 3, 4]]     # Retried rows go ahead of newer ones
+  assert buffer.pending() == 0
+
+def test_rejected_rows_are_found_and_discarded(table):
+  buffer = WriteBehindBuffer(table, "test")
+  table.bad_rows = {5}
+  discarded = counted(metrics.ingest_discarded_rows)
+  buffer.add(list(range(1, 9)))
+  buffer.flush()
+  assert table.rows == [1, 2, 3, 4, 6, 7, 8]
+  assert buffer.pending() == 0
+  assert counted(metrics.ingest_discarded_rows) - discarded == 1
+
+def test_rows_are_kept_when_the_database_fails_while_splitting(table):
+  buffer = WriteBehindBuffer(table, "test")
+  table.bad_rows = {2}
+  table.failures = [errors.DataError(msg="Out of range value"), errors.OperationalError(msg="Lost connection")]
+  buffer.add([1, 2, 3, 4])
+  buffer.flush()     # The whole batch is rejected, then the first half fails on the lost connection
+  assert table.rows == [] and buffer.pending() == 4
+  buffer.flush()
+  assert table.rows == [1, 3, 4]
+
+def test_oldest_rows_are_dropped_when_retries_overflow_the_buffer(table):
+  buffer = WriteBehindBuffer(table, "test", max_pending=4)
+  def fail_while_new_rows_arrive(rows):
+    buffer.add([4, 5, 6])
+    raise errors.OperationalError(msg="Lost connection")
+  buffer.flush_rows = fail_while_new_rows_arrive
+  dropped = counted(metrics.ingest_dropped_rows)
+  buffer.add([1, 2, 3])
+  buffer.flush()
+  assert counted(metrics.ingest_dropped_rows) - dropped == 2
+  buffer.flush_rows = table
+  buffer.flush()
+  assert table.rows == [3, 4, 5, 6]
+
+def test_full_buffer_refuses_rows(table):
+  buffer = WriteBehindBuffer(table, "test", max_pending=3)
+  assert buffer.add([1, 2])
+  assert not buffer.add([3, 4])
+  assert buffer.pending() == 2
+
+def bulk(count: int) -> list:
+  start = datetime(2024, 1, 2, 3, 4, 5)
+  return [{"appliance_name": "desk_lamp", "local_time": str(start + timedelta(seconds=5 * index)), "current_power": 1500,
+           "distance_ultrasonic": 0, "distance_bluetooth": 120, "distance_ultrawideband": 95, "user_presence_detected": True}
+          for index in range(count)]
+
+@pytest.fixture
+def queued(monkeypatch, table):    # Rows the bulk route queued, read back by flushing the (not started) periodic buffer
+  periodic_buffer.flush()
+  monkeypatch.setattr(periodic_buffer, "flush_rows", table)
+  def flush():
+    periodic_buffer.flush()
+    return table.rows
+  yield flush
+  periodic_buffer.flush()
+
+def test_bulk_route_queues_every_sample(api, queued):
+  response = api.post("/shuteye_periodic_measurement_data/bulk", json=bulk(5))
+  assert response.status_code == 202 and response.json() == {"queued": 5}
+  assert [row[1].second for row in queued()] == [5, 10, 15, 20, 25]
+
+def test_bulk_route_queues_nothing_if_a_sample_is_invalid(api, queued):
+  samples = bulk(3)
+  samples[1]["current_power"] = "lots"
+  response = api.post("/shuteye_periodic_measurement_data/bulk", json=samples)
+  assert response.status_code == 422 and response.json()["error"].startswith("Sample 1:")
+  assert queued() == []
+
+@pytest.mark.parametrize("setting", ["server.max_bulk", "ingest.periodic_buffer.max_pending"])
+def test_bulk_route_refuses_arrays_that_can_never_fit(api, queued, monkeypatch, setting):
+  monkeypatch.setattr(setting, 3)
+  response = api.post("/shuteye_periodic_measurement_data/bulk", json=bulk(4))
+  assert response.status_code == 413
+  assert queued() == []
+
+def test_bulk_route_asks_to_retry_when_the_buffer_is_full(api, queued, monkeypatch):
+  monkeypatch.setattr(periodic_buffer, "max_pending", 3)
+  periodic_buffer.add([("desk_lamp", datetime(2024, 1, 1), 0, 0, 0, 0, False)] * 2)
+  rejected = counted(metrics.ingest_rejected, "periodic")
+  response = api.post("/shuteye_periodic_measurement_data/bulk", json=bulk(2))
+  assert response.status_code == 503
+  assert counted(metrics.ingest_rejected, "periodic") - rejected == 2
+  assert len(queued()) == 2
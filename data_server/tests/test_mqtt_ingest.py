@@ -0,0 +1,143 @@
+import json
+from datetime import datetime
+import pytest
+import metrics
+import mqtt_ingest
+from ingest import periodic_buffer, historical_buffer
+
+class FakeClient:     # Local stand-in for a paho client: records what mqtt_ingest asks of it, and tests deliver messages through its callbacks
+  def __init__(self):
+    self.subscriptions = []
+    self.connected_to = None
+    self.looping = False
+    self.on_connect = None
+    self.on_message = None
+    self.manual_ack = False
+    self.acked = []
+    self.next_mid = 1
+
+  def connect_async(self, host, port, keepalive=60):
+    self.connected_to = (host, port)
+
+  def loop_start(self):
+    self.looping = True
+
+  def loop_stop(self):
+    self.looping = False
+
+  def disconnect(self):
+    self.connected_to = None
+
+  def subscribe(self, topics):
+    self.subscriptions.extend(topics)
+
+  def publish(self, topic, payload) -> int:    # Delivers a QoS 1 message the way paho's network loop would, returns its message id
+    mid, self.next_mid = self.next_mid, self.next_mid + 1
+    message = type("Message", (), {"topic": topic, "payload": json.dumps(payload).encode() if not isinstance(payload, bytes) else payload,
+                                   "mid": mid, "qos": 1})
+    self.on_message(self, None, message)
+    return mid
+
+class ManualAckClient(FakeClient):     # Like paho-mqtt 2.x, which can leave acknowledging QoS 1 messages to the application (paho-mqtt 1.x acknowledges when on_message returns)
+  def manual_ack_set(self, on):
+    self.manual_ack = on
+
+  def ack(self, mid, qos):
+    self.acked.append(mid)
+
+@pytest.fixture
+def client():
+  client = ManualAckClient()
+  mqtt_ingest.start(client=client)
+  client.on_connect(client, None, {}, 0)
+  yield client
+  mqtt_ingest.stop()
+
+@pytest.fixture
+def written(monkeypatch):    # Rows the write-behind buffers would have inserted, by kind
+  rows = {"periodic": [], "historical": []}
+  for kind, buffer in (("periodic", periodic_buffer), ("historical", historical_buffer)):
+    buffer.flush()
+    monkeypatch.setattr(buffer, "flush_rows", rows[kind].extend)
+  yield rows
+
+def flush():
+  periodic_buffer.flush()
+  historical_buffer.flush()
+
+def periodic_sample(**fields):
+  sample = {"local_time": "2024-01-02 03:04:05", "current_power": 1500, "distance_ultrasonic": 0, "distance_bluetooth": 120,
+            "distance_ultrawideband": 95, "user_presence_detected": True}
+  sample.update(fields)
+  return sample
+
+def test_start_connects_and_subscribes(client):
+  assert client.looping
+  assert client.manual_ack
+  assert client.connected_to is not None
+  assert [topic for topic, qos in client.subscriptions] == ["shuteye/+/periodic", "shuteye/+/historical"]
+
+def test_periodic_sample_takes_appliance_name_from_topic(client, written):
+  mid = client.publish("shuteye/desk_lamp/periodic", periodic_sample())
+  flush()
+  assert written["periodic"] == [("desk_lamp", datetime(2024, 1, 2, 3, 4, 5), 1500, 0, 120, 95, True)]
+  assert client.acked == [mid]
+
+def test_array_of_samples_is_queued(client, written):
+  client.publish("shuteye/desk_lamp/periodic", [periodic_sample(local_time=f"2024-01-02 03:04:0{second}") for second in range(5)])
+  flush()
+  assert [row[1].second for row in written["periodic"]] == [0, 1, 2, 3, 4]
+
+def test_historical_data(client, written):
+  client.publish("shuteye/desk_lamp/historical", {"local_time": "2024-01-02 03:04:05", "today_runtime": 60, "month_runtime": 600,
+                                                 "today_energy": 250, "month_energy": 4000})
+  flush()
+  assert written["historical"] == [("desk_lamp", datetime(2024, 1, 2, 3, 4, 5), 60, 600, 250, 4000)]
+
+@pytest.mark.parametrize("topic, payload", [
+  ("shuteye/desk_lamp/periodic", b"not json"),
+  ("shuteye/desk_lamp/periodic", periodic_sample(current_power="lots")),
+  ("shuteye/desk_lamp/periodic", periodic_sample(appliance_name="someone_else")),
+  ("shuteye/desk_lamp/unknown", periodic_sample()),
+  ("other/desk_lamp/periodic", periodic_sample()),
+  ("shuteye/desk_lamp/periodic", [periodic_sample()] * 1001),     # More than INGEST_MAX_BULK samples could never be queued
+])
+def test_invalid_messages_are_dropped(client, written, topic, payload):
+  mid = client.publish(topic, payload)
+  flush()
+  assert written["periodic"] == []
+  assert client.acked == [mid]     # Redelivering them would not help
+
+def test_unexpected_errors_do_not_escape_the_callback(client, monkeypatch):
+  def fail(topic, payload):
+    raise TypeError("unexpected")
+  monkeypatch.setattr(mqtt_ingest, "handle_message", fail)
+  client.publish("shuteye/desk_lamp/periodic", periodic_sample())     # Raising here would stop paho's network loop
+  assert client.acked == []
+
+def test_full_buffer_drops_message_after_backpressure_timeout(client, written, monkeypatch):
+  monkeypatch.setattr(mqtt_ingest, "backpressure_timeout", 0.3)     # Several attempts to add the rows
+  monkeypatch.setattr(periodic_buffer, "max_pending", 2)
+  queued = [("fridge", datetime(2024, 1, 1), 0, 0, 0, 0, False)] * 2
+  periodic_buffer.add(queued)
+  rejected = metrics.ingest_rejected._values.get(("periodic",), 0)
+  client.publish("shuteye/desk_lamp/periodic", [periodic_sample(), periodic_sample(local_time="2024-01-02 03:04:10")])
+  flush()
+  assert written["periodic"] == queued
+  assert metrics.ingest_rejected._values.get(("periodic",), 0) - rejected == 2     # Counted once, when the message is given up on
+  assert client.acked == []     # The broker keeps the message and sends it again
+
+def test_clients_without_manual_acks_are_supported(written):
+  client = FakeClient()
+  mqtt_ingest.start(client=client)
+  try:
+    client.publish("shuteye/desk_lamp/periodic", periodic_sample())
+    client.publish("shuteye/desk_lamp/periodic", b"not json")
+  finally:
+    mqtt_ingest.stop()
+  flush()
+  assert len(written["periodic"]) == 1
+
+def test_stop_disconnects(client):
+  mqtt_ingest.stop()
+  assert client.connected_to is None and not client.looping
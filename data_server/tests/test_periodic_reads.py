@@ -0,0 +1,95 @@
+import json
+from datetime import datetime, timedelta
+import pytest
+from mysql.connector import errors
+import db
+import retention
+from ingest import insert_periodic_rows
+
+DAY = datetime(2024, 1, 2)
+COMPACTED_UNTIL = DAY + timedelta(days=1)
+TIMES = [DAY + timedelta(minutes=10 * index) for index in range(2 * 144)]     # Two days, the first of them compacted
+URL = "/shuteye_periodic_measurement_data/fridge"
+
+def text(time: datetime) -> str:
+  return time.strftime("%Y-%m-%d %H:%M:%S")
+
+@pytest.fixture
+def stored(api, monkeypatch):    # Samples every 10 minutes over two days, the first day archived by the retention job
+  monkeypatch.setattr("server.STREAM_CHUNK_ROWS", 7)     # Many keyset queries, with chunks that do not line up with the pages
+  insert_periodic_rows([("fridge", time, index, 10, 20, 30, index % 2 == 0) for index, time in enumerate(TIMES)])
+  retention.run_retention(COMPACTED_UNTIL + timedelta(days=retention.raw_retention_days))
+  with db.get_cursor() as cursor:
+    cursor.execute("SELECT COUNT(*) FROM ShutEyeDeviceEnergyDataPeriodicMeasurement;")
+    assert cursor.fetchall()[0][0] == 144
+  return api
+
+def page(api, **params) -> tuple:    # Local times of one page of the json format and its X-Next-Cursor
+  response = api.get(URL, params=params)
+  assert response.status_code == 200
+  return [row["local_time"] for row in response.json().values()], response.headers.get("X-Next-Cursor")
+
+def test_all_rows_come_from_the_archive_then_the_database(stored):
+  assert page(stored)[0] == [text(time) for time in TIMES]
+
+@pytest.mark.parametrize("limit", [1, 50, 144, 287])
+def test_paging_with_the_cursor_returns_every_row_once(stored, limit):
+  times, cursor, pages = [], None, 0
+  while True:
+    rows, cursor = page(stored, limit=limit, **({"after": cursor} if cursor else {}))
+    times += rows
+    pages += 1
+    if cursor is None:
+      break
+    assert cursor == rows[-1]
+  assert times == [text(time) for time in TIMES]
+  assert pages == len(TIMES) // limit + 1
+
+@pytest.mark.parametrize("after", [TIMES[138], TIMES[-6]])     # Five rows left in the archive, and in the database
+def test_limit_equal_to_the_remaining_rows(stored, after):
+  index = TIMES.index(after)
+  rows, cursor = page(stored, after=text(after), limit=5)
+  assert rows == [text(time) for time in TIMES[index + 1:index + 6]]
+  assert cursor == rows[-1]     # Full page, so the client cannot know it was the last
+  rows, cursor = page(stored, after=cursor, limit=5)
+  if index + 6 < len(TIMES):
+    assert rows[0] == text(COMPACTED_UNTIL)
+  else:
+    assert rows == [] and cursor is None
+
+@pytest.mark.parametrize("start, end", [
+  (DAY + timedelta(hours=20), COMPACTED_UNTIL + timedelta(hours=4)),    # Across compacted_until
+  (DAY + timedelta(hours=3, minutes=5), DAY + timedelta(hours=5)),      # Archive only, start between samples
+  (COMPACTED_UNTIL, COMPACTED_UNTIL + timedelta(minutes=30)),            # Database only, starting on compacted_until
+])
+def test_start_is_inclusive_and_end_exclusive(stored, start, end):
+  assert page(stored, start=text(start), end=text(end))[0] == [text(time) for time in TIMES if start <= time < end]
+
+def test_bounds_and_cursor_together(stored):
+  start, end = DAY + timedelta(hours=22), COMPACTED_UNTIL + timedelta(hours=2)
+  rows, cursor = page(stored, start=text(start), end=text(end), limit=10)
+  while cursor is not None:
+    more, cursor = page(stored, start=text(start), end=text(end), limit=10, after=cursor)
+    rows += more
+  assert rows == [text(time) for time in TIMES if start <= time < end]
+
+def test_columnar_format_returns_the_cursor_in_the_body(stored):
+  response = stored.get(URL, params={"format": "columnar", "after": text(TIMES[140]), "limit": 6})
+  body = response.json()
+  assert body["local_time"] == [text(time) for time in TIMES[141:147]]
+  assert body["next_cursor"] == response.headers["X-Next-Cursor"] == body["local_time"][-1]
+
+def test_ndjson_streams_every_row(stored):
+  response = stored.get(URL, params={"format": "ndjson", "start": text(DAY + timedelta(hours=12)), "limit": 100})
+  assert response.status_code == 200
+  rows = [json.loads(line) for line in response.text.splitlines()]
+  assert [row["local_time"] for row in rows] == [text(time) for time in TIMES[72:172]]
+  assert rows[0]["current_power"] == 72
+
+def test_ndjson_reports_a_database_error_before_the_first_chunk(stored, monkeypatch):
+  def fail():
+    raise errors.OperationalError(msg="Can't connect to MySQL server")
+  monkeypatch.setattr(db, "checkout_connection", fail)
+  response = stored.get(URL, params={"format": "ndjson", "start": text(COMPACTED_UNTIL)})
+  assert response.status_code == 500
+  assert "Database error" in response.json()["error"]
@@ -0,0 +1,65 @@
+import random
+from datetime import datetime, timedelta
+import pytest
+from aggregate import energy_summary
+from ingest import insert_periodic_rows
+from retention import run_retention
+
+DAY = datetime(2024, 1, 2)
+NOW = DAY + timedelta(days=60)     # Far enough after DAY that retention compacts it
+
+def sample(time: datetime, power: int, present: bool = True) -> tuple:
+  return ("fridge", time, power, 10, 20, 30, present)
+
+@pytest.fixture
+def rows(database):    # 2000 irregularly spaced samples from the start of DAY, stored in the raw table
+  rng = random.Random(2)
+  rows = []
+  time = DAY
+  for _ in range(2000):
+    rows.append(sample(time, rng.randint(0, 60000), rng.random() < 0.5))
+    time += timedelta(seconds=rng.choice([3, 5, 7]))
+  insert_periodic_rows(rows)
+  return rows
+
+def hourly_energy(api) -> list:
+  response = api.get("/shuteye_energy_summary/fridge", params={"date": DAY.strftime("%Y-%m-%d")})
+  assert response.status_code == 200
+  return response.json()["total_energy_wh"]
+
+def raw_hourly_energy(rows: list) -> list:
+  rows = sorted(rows, key=lambda row: row[1])
+  return energy_summary([row[1] for row in rows], [row[2] for row in rows], [row[6] for row in rows], DAY, DAY + timedelta(days=1), 3600)["total_energy_wh"]
+
+def test_compacted_summary_matches_raw(api, rows):
+  raw = hourly_energy(api)
+  assert run_retention(NOW) == len(rows)
+  assert hourly_energy(api) == pytest.approx(raw)
+
+def test_late_and_repeated_samples_are_not_counted_twice(api, rows):
+  run_retention(NOW)
+  late = sample(DAY + timedelta(seconds=1), 50000)     # Falls between the first two samples of the compacted day
+  repeated = sample(rows[10][1], 60000)                # Already archived, the first copy is kept
+  insert_periodic_rows([late, repeated])
+  assert run_retention(NOW) == 2
+  assert hourly_energy(api) == pytest.approx(raw_hourly_energy(rows + [late]))
+  run_retention(NOW)     # Nothing left to compact, the rollups stay as they are
+  assert hourly_energy(api) == pytest.approx(raw_hourly_energy(rows + [late]))
+
+@pytest.mark.parametrize("offset, bucket_minutes, minute_retention_days", [
+  (timedelta(minutes=30), 60, 100000),   # Start not on the hour: minute rollups
+  (timedelta(minutes=30), 60, 1),        # ... and from the archive once the minute rollups have expired
+  (timedelta(0), 15, 100000),            # Sub-hour buckets: minute rollups
+  (timedelta(0), 15, 1),                 # ... and from the archive once the minute rollups have expired
+  (timedelta(seconds=30), 15, 100000),   # Start not on the minute: archive
+])
+def test_compacted_summary_matches_raw_for_any_buckets(api, rows, monkeypatch, offset, bucket_minutes, minute_retention_days):
+  monkeypatch.setattr("retention.minute_retention_days", minute_retention_days)
+  params = {"start": str(DAY + offset), "end": str(DAY + offset + timedelta(hours=3)), "bucket_minutes": bucket_minutes}
+  raw = api.get("/shuteye_energy_summary/fridge", params=params).json()
+  run_retention(NOW)
+  compacted = api.get("/shuteye_energy_summary/fridge", params=params).json()
+  assert compacted["bucket_start"] == raw["bucket_start"]
+  assert sum(raw["total_energy_wh"]) > 0
+  for column in ("total_energy_wh", "presence_energy_wh", "presence_percentage"):
+    assert compacted[column] == pytest.approx(raw[column])